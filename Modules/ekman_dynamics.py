@@ -1,7 +1,9 @@
 import numpy as np
 import xarray as xr
+from profiling import profile_stage
 
 
+@profile_stage('windstress')
 def compute_windstress(u, v, rho_air=1.293, Cd=1.3e-3):
     """
     Compute wind stress components using 3D xarray DataArrays (e.g., time, lat, lon).
@@ -27,6 +29,7 @@ def compute_windstress(u, v, rho_air=1.293, Cd=1.3e-3):
 
 
 
+@profile_stage('windstress_curl')
 def compute_windstress_curl(tau_u, tau_v):
     """
     Compute the curl of wind stress using 3D xarray DataArrays.
@@ -59,6 +62,7 @@ def compute_windstress_curl(tau_u, tau_v):
     return curl_tau
 
 
+@profile_stage('ekman_transport')
 def compute_ekman_transport(tau_u, tau_v, rho_water=1025):
     """
     Compute Ekman transport using 3D xarray DataArrays.
@@ -103,6 +107,7 @@ def compute_ekman_transport(tau_u, tau_v, rho_water=1025):
     return M_u, M_v, mean_Ekman
 
 
+@profile_stage('ekman_pumping')
 def compute_ekman_pumping(curl_tau, rho_water=1025):
     """
     Compute Ekman pumping velocity using 3D xarray DataArrays.
@@ -142,7 +147,8 @@ def compute_ekman_pumping(curl_tau, rho_water=1025):
 
 
 
-def compute_ekman_properties(u, v, rho_air=1.293, Cd=1.3e-3, rho_water=1025):
+@profile_stage('ekman_properties')
+def compute_ekman_properties(u, v, rho_air=1.293, Cd=1.3e-3, rho_water=1025, cache=None):
     """
     Compute Ekman transport and Ekman pumping from wind velocity components.
     
@@ -150,6 +156,7 @@ def compute_ekman_properties(u, v, rho_air=1.293, Cd=1.3e-3, rho_water=1025):
     - u, v: Wind velocity components in m/s (3D xarray.DataArray: time, lat, lon).
     - Cd: Drag coefficient. Default is 1.3e-3.
     - rho_water: Water density in kg/m^3. Default is 1025 kg/m^3.
+    - cache: Optional result_cache.ResultCache to reuse products computed before for the same winds.
     
     Returns:
     - curl_tau: Wind stress curl in N/m^3 (3D xarray.DataArray: time, lat, lon).
@@ -157,7 +164,15 @@ def compute_ekman_properties(u, v, rho_air=1.293, Cd=1.3e-3, rho_water=1025):
     - mean_Ekman: Absolute Ekman transport in m^2/s (3D xarray.DataArray: time, lat, lon).
     - w_E: Ekman pumping velocity in m/s (3D xarray.DataArray: time, lat, lon).
     """
-    
+    if cache is not None:
+        params = {'rho_air': rho_air, 'Cd': Cd, 'rho_water': rho_water}
+        return cache.get_or_compute((u, v), 'ekman_dynamics.compute_ekman_properties', params,
+                                    lambda: _compute_ekman_properties(u, v, rho_air, Cd, rho_water))
+    return _compute_ekman_properties(u, v, rho_air, Cd, rho_water)
+
+
+def _compute_ekman_properties(u, v, rho_air, Cd, rho_water):
+    """Computes the Ekman properties from wind velocity without using the cache."""
     # Compute wind stress
     tau_u, tau_v = compute_windstress(u, v, rho_air, Cd)
     
@@ -174,13 +189,14 @@ def compute_ekman_properties(u, v, rho_air=1.293, Cd=1.3e-3, rho_water=1025):
     
     return curl_tau, M_u, M_v, mean_Ekman, w_E
 
-def compute_ekman_properties_from_stress(tau_u, tau_v, rho_water=1025):
+@profile_stage('ekman_properties_from_stress')
+def compute_ekman_properties_from_stress(tau_u, tau_v, rho_water=1025, cache=None):
     """
     Compute Ekman transport and Ekman pumping from wind velocity components.
     
     Parameters:
     - u, v: Wind velocity components in m/s (3D xarray.DataArray: time, lat, lon).
-    - 
+    - cache: Optional result_cache.ResultCache to reuse products computed before for the same wind stress.
     
     Returns:
     - curl_tau: Wind stress curl in N/m^3 (3D xarray.DataArray: time, lat, lon).
@@ -188,8 +204,15 @@ def compute_ekman_properties_from_stress(tau_u, tau_v, rho_water=1025):
     - mean_Ekman: Absolute Ekman transport in m^2/s (3D xarray.DataArray: time, lat, lon).
     - w_E: Ekman pumping velocity in m/s (3D xarray.DataArray: time, lat, lon).
     """
-    
-    
+    if cache is not None:
+        return cache.get_or_compute((tau_u, tau_v), 'ekman_dynamics.compute_ekman_properties_from_stress',
+                                    {'rho_water': rho_water},
+                                    lambda: _compute_ekman_properties_from_stress(tau_u, tau_v, rho_water))
+    return _compute_ekman_properties_from_stress(tau_u, tau_v, rho_water)
+
+
+def _compute_ekman_properties_from_stress(tau_u, tau_v, rho_water):
+    """Computes the Ekman properties from wind stress without using the cache."""
     # Compute curl of wind stress
     curl_tau = compute_windstress_curl(tau_u, tau_v)
     
@@ -0,0 +1,104 @@
+"""
+Import-time benchmark for the analysis modules.
+
+Imports every compute module in a fresh interpreter, measures the import time with
+`python -X importtime` and checks that no plotting or wavelet libraries are loaded.
+Exits with status 1 if a check fails, so it can guard against regressions in nightly runs:
+
+    python Modules/import_benchmark.py
+    python Modules/import_benchmark.py --save-baseline import_times.json
+    python Modules/import_benchmark.py --baseline import_times.json --tolerance 1.5
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEARCH_PATHS = [os.path.join(REPO_DIR, 'Modules'), os.path.join(REPO_DIR, 'Session2_DataHandling')]
+
+# Modules whose compute functions are used in batch and dask workers
+COMPUTE_MODULES = ['profiling', 'result_cache', 'ekman_dynamics', 'timeseries_analyzer',
+                   'trend_analysis', 'enso_functions', 'marine_heatwaves']
+
+# Libraries that must only be loaded on first use of a plotting or wavelet function
+FORBIDDEN_MODULES = ['matplotlib', 'mpl_toolkits.basemap', 'pycwt', 'scipy.stats', 'scipy.signal']
+
+
+def measure_import(module, repeats=3):
+    """
+    Imports a module in fresh interpreters and returns the fastest import time and the
+    forbidden libraries that were loaded.
+
+    Parameters:
+    - module: Name of the module to import.
+    - repeats: Number of fresh interpreters to use; the minimum time is reported.
+
+    Returns:
+    - seconds: Cumulative import time of the module in seconds.
+    - loaded: List of forbidden libraries found in sys.modules after the import.
+    """
+    code = (f"import sys, json; import {module}; "
+            f"print(json.dumps([m for m in {FORBIDDEN_MODULES!r} if m in sys.modules]))")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(SEARCH_PATHS + [os.environ.get('PYTHONPATH', '')]),
+               MPLBACKEND='Agg')
+    times = []
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                capture_output=True, text=True, env=env)
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr.splitlines()[-1]}")
+        # Lines look like "import time:  self [us] | cumulative | imported package"
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                times.append(int(fields[1]) / 1e6)
+        loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return min(times), loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=COMPUTE_MODULES, help='Modules to check.')
+    parser.add_argument('--repeats', type=int, default=3, help='Fresh interpreters per module.')
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help='Fail if any module takes longer than this to import.')
+    parser.add_argument('--baseline', help='JSON file with reference import times.')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Allowed slowdown factor relative to the baseline.')
+    parser.add_argument('--save-baseline', help='Write the measured import times to this JSON file.')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    failures = []
+    measured = {}
+    print(f"{'module':<22}{'import [s]':>12}{'baseline [s]':>14}  forbidden libraries")
+    for module in args.modules:
+        seconds, loaded = measure_import(module, args.repeats)
+        measured[module] = seconds
+        reference = baseline.get(module)
+        print(f"{module:<22}{seconds:>12.3f}{(reference if reference is not None else float('nan')):>14.3f}  "
+              f"{', '.join(loaded) or '-'}")
+        if loaded:
+            failures.append(f"{module} loads {', '.join(loaded)} at import time")
+        if args.max_seconds is not None and seconds > args.max_seconds:
+            failures.append(f"{module} takes {seconds:.3f}s to import (limit {args.max_seconds}s)")
+        if reference is not None and seconds > reference * args.tolerance:
+            failures.append(f"{module} import slowed down from {reference:.3f}s to {seconds:.3f}s")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(measured, f, indent=2)
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
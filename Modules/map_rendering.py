@@ -0,0 +1,367 @@
+import os
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def use_headless_backend():
+    """
+    Switches matplotlib to the non-interactive Agg backend, so figures can be rendered
+    to files in batch jobs and worker processes without a display.
+    """
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+
+def adjust_longitude(data_array, central_lon):
+    """
+    Shifts the longitudes to -180..180 (central_lon=0) or 0..360 (central_lon=180) and sorts by
+    longitude, like trend_analysis.adjust_longitude.
+    """
+    if central_lon not in [0, 180]:
+        raise ValueError("central_lon must be either 0 or 180.")
+    lon = data_array['lon']
+    if central_lon == 0:
+        lon = np.where(lon > 180, lon - 360, lon)
+    else:
+        lon = np.where(lon < 0, lon + 360, lon)
+    return data_array.assign_coords(lon=lon).sortby('lon')
+
+
+@functools.lru_cache(maxsize=8)
+def get_projection(projection='robin', central_lon=180, resolution='c'):
+    """
+    Returns a Basemap instance for the projection. Instances are cached per process, so the
+    coastline data is only read once and the same object is reused for all maps.
+
+    Parameters:
+    - projection: Basemap projection name (default 'robin' for Robinson).
+    - central_lon: Central longitude of the map (default 180).
+    - resolution: Resolution of the boundary datasets ('c', 'l', 'i', 'h', 'f').
+    """
+    from mpl_toolkits.basemap import Basemap
+    return Basemap(projection=projection, lon_0=central_lon, resolution=resolution)
+
+
+@functools.lru_cache(maxsize=32)
+def _projected_grid(lon, lat, projection, central_lon, resolution):
+    """Cached part of project_grid, lon and lat are passed as tuples."""
+    m = get_projection(projection, central_lon, resolution)
+    lons, lats = np.meshgrid(lon, lat)
+    x, y = m(lons, lats)
+    # The cached arrays are shared between maps and must not be modified
+    x.flags.writeable = False
+    y.flags.writeable = False
+    return x, y
+
+
+def project_grid(lon, lat, projection='robin', central_lon=180, resolution='c'):
+    """
+    Returns the projected x/y coordinates (2D) of a regular lon/lat grid.
+    The result is cached per grid and projection.
+
+    Parameters:
+    - lon, lat: 1D arrays (or xarray coordinates) of longitudes and latitudes.
+    - projection, central_lon, resolution: See get_projection().
+    """
+    lon = tuple(np.asarray(lon, dtype=float).tolist())
+    lat = tuple(np.asarray(lat, dtype=float).tolist())
+    return _projected_grid(lon, lat, projection, central_lon, resolution)
+
+
+@functools.lru_cache(maxsize=8)
+def _coastline_layers(projection, central_lon, resolution):
+    """
+    Returns the coastline segments and the land and lake polygons of a projection as arrays,
+    so they can be drawn as one collection each instead of one patch per polygon.
+    """
+    m = get_projection(projection, central_lon, resolution)
+    land, lakes = [], []
+    for (x, y), kind in zip(m.coastpolygons, m.coastpolygontypes):
+        polygon = np.column_stack([x, y]).astype(np.float32)
+        # Types 2 and 4 are lakes (and lakes on islands in lakes), everything else is land
+        (lakes if kind in (2, 4) else land).append(polygon)
+    return m.coastsegs, land, lakes
+
+
+@functools.lru_cache(maxsize=8)
+def _map_outline(projection, central_lon, resolution):
+    """
+    Returns the projected outline of the map domain (the limb) as an (n, 2) array, obtained by
+    projecting the edges of the domain in lon/lat. The edges are moved inwards by a tiny amount,
+    because points exactly on the dateline opposite of central_lon are ambiguous.
+    """
+    m = get_projection(projection, central_lon, resolution)
+    eps = 1e-4
+    lon_min, lon_max = m.llcrnrlon + eps, m.urcrnrlon - eps
+    lat_min, lat_max = max(m.llcrnrlat, -90 + eps), min(m.urcrnrlat, 90 - eps)
+    n = 100
+    lons = np.concatenate([np.full(n, lon_min), np.linspace(lon_min, lon_max, n),
+                           np.full(n, lon_max), np.linspace(lon_max, lon_min, n)])
+    lats = np.concatenate([np.linspace(lat_min, lat_max, n), np.full(n, lat_max),
+                           np.linspace(lat_max, lat_min, n), np.full(n, lat_min)])
+    x, y = m(lons, lats)
+    return np.column_stack([x, y])
+
+
+def _format_lat(lat):
+    """Formats a latitude like Basemap's parallel labels (e.g. 30°N)."""
+    return '0°' if lat == 0 else f"{abs(lat):g}°{'N' if lat > 0 else 'S'}"
+
+
+def _format_lon(lon):
+    """Formats a longitude like Basemap's meridian labels (e.g. 120°W, 180°)."""
+    lon = (lon + 180) % 360 - 180
+    if lon in (0, -180):
+        return f'{abs(lon):g}°'
+    return f"{abs(lon):g}°{'E' if lon > 0 else 'W'}"
+
+
+@functools.lru_cache(maxsize=8)
+def _graticule(projection, central_lon, resolution, parallels=(-60, -30, 0, 30, 60), meridians=(0, 60, 120, 180, 240, 300)):
+    """
+    Returns the projected parallels and meridians as line segments, and the positions and texts
+    of their labels (parallels at the left edge of the map, meridians at the bottom).
+    Meridians on the edge of the domain coincide with the map boundary and are left out.
+    """
+    m = get_projection(projection, central_lon, resolution)
+    eps = 1e-4
+    lon_min, lon_max = m.llcrnrlon + eps, m.urcrnrlon - eps
+    lat_min, lat_max = max(m.llcrnrlat, -90 + eps), min(m.urcrnrlat, 90 - eps)
+    lines, parallel_labels, meridian_labels = [], [], []
+
+    lons = np.linspace(lon_min, lon_max, 181)
+    for lat in parallels:
+        if lat_min <= lat <= lat_max:
+            x, y = m(lons, np.full_like(lons, lat))
+            lines.append(np.column_stack([x, y]))
+            parallel_labels.append((x[0], y[0], _format_lat(lat)))
+
+    lats = np.linspace(lat_min, lat_max, 181)
+    for lon in meridians:
+        lon = (lon - lon_min) % 360 + lon_min  # same meridian within the domain
+        if lon - lon_min < 1 or lon_max - lon < 1:
+            continue
+        x, y = m(np.full_like(lats, lon), lats)
+        lines.append(np.column_stack([x, y]))
+        meridian_labels.append((x[0], y[0], _format_lon(lon)))
+    return lines, parallel_labels, meridian_labels
+
+
+def draw_basemap_layers(ax, projection='robin', central_lon=180, resolution='c',
+                        land_color='white', lake_color='lightblue', coast_color='k'):
+    """
+    Draws the map boundary, continents, coastlines, parallels and meridians of a projection onto ax.
+    Everything is drawn from cached, projected geometry with plain matplotlib artists, so the shared
+    Basemap instance is never bound to an axes and can be used for any number of figures.
+    Returns the boundary patch (limb), which can be used to clip data drawn on the map.
+    """
+    from matplotlib.collections import LineCollection, PolyCollection
+    from matplotlib.patches import Polygon
+
+    m = get_projection(projection, central_lon, resolution)
+    limb = Polygon(_map_outline(projection, central_lon, resolution), closed=True,
+                   facecolor='none', edgecolor=coast_color, linewidth=1.0, zorder=4)
+    ax.add_patch(limb)
+
+    coastsegs, land, lakes = _coastline_layers(projection, central_lon, resolution)
+    lines, parallel_labels, meridian_labels = _graticule(projection, central_lon, resolution)
+    layers = [PolyCollection(land, facecolors=land_color, edgecolors='none', zorder=2),
+              PolyCollection(lakes, facecolors=lake_color, edgecolors='none', zorder=2),
+              LineCollection(coastsegs, colors=coast_color, linewidths=1.0, zorder=3),
+              LineCollection(lines, colors='gray', linewidths=0.5, linestyles='--', zorder=3)]
+    for layer in layers:
+        ax.add_collection(layer)
+        layer.set_clip_path(limb)
+
+    # Label the parallels left of the map and the meridians below it
+    offset = 0.01 * (m.urcrnrx - m.llcrnrx)
+    for x, y, text in parallel_labels:
+        ax.text(x - offset, y, text, ha='right', va='center', clip_on=False)
+    for x, y, text in meridian_labels:
+        ax.text(x, y - offset, text, ha='center', va='top', clip_on=False)
+
+    ax.set_xlim(m.llcrnrx, m.urcrnrx)
+    ax.set_ylim(m.llcrnry, m.urcrnry)
+    ax.set_aspect('equal')
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_frame_on(False)
+    return limb
+
+
+def draw_map(ax, data, vmin=-0.5, vmax=0.5, cmap='RdBu_r', label='', title='', projection='robin',
+             central_lon=180, resolution='c', nlevels=21, contour_lines=True):
+    """
+    Draws a 2D lon/lat field onto ax, either on a cached Basemap projection or, with
+    projection=None, as a plain xarray plot on the lon/lat grid. Only ax and its figure are
+    used, so maps can be drawn into figures that are not managed by pyplot.
+
+    Parameters:
+    - ax: Matplotlib axes to draw on.
+    - data: 2D xarray.DataArray with lat and lon coordinates.
+    - vmin, vmax: Range of the color scale.
+    - cmap: Colormap name.
+    - label: Label of the colorbar.
+    - title: Title of the panel.
+    - projection: Basemap projection name, or None for a plain lon/lat plot.
+    - central_lon: Central longitude of the projection (0 or 180).
+    - resolution: Resolution of the coastlines.
+    - nlevels: Number of contour levels for projected maps.
+    - contour_lines: Whether to draw labelled contour lines on projected maps.
+    """
+    from matplotlib.ticker import MaxNLocator
+
+    if projection is None:
+        mappable = data.plot(ax=ax, vmin=vmin, vmax=vmax, cmap=cmap, add_colorbar=False)
+        ax.figure.colorbar(mappable, ax=ax, label=label)
+        ax.set_title(title)
+        return ax
+
+    from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+    data = adjust_longitude(data, central_lon)
+    levels = MaxNLocator(nbins=nlevels).tick_values(vmin, vmax)
+    x, y = project_grid(data['lon'], data['lat'], projection, central_lon, resolution)
+    limb = draw_basemap_layers(ax, projection, central_lon, resolution)
+
+    cf = ax.contourf(x, y, data.values, levels=levels, cmap=cmap, extend='neither', zorder=1)
+    cf.set_clip_path(limb)
+    if contour_lines:
+        lines = ax.contour(x, y, data.values, levels=levels, colors='grey', linewidths=0.5, zorder=1)
+        lines.set_clip_path(limb)
+        ax.clabel(lines, inline=True, fontsize=8, fmt='%1.2f')
+
+    # Colorbar next to the map, with the same height (as Basemap.colorbar does)
+    cax = make_axes_locatable(ax).append_axes('right', size='5%', pad='5%')
+    cbar = ax.figure.colorbar(cf, cax=cax)
+    cbar.set_label(label)
+    cbar.ax.yaxis.set_major_locator(MaxNLocator(nbins=7))
+    ax.set_title(title)
+    return ax
+
+
+def render_frame(frame):
+    """
+    Renders one frame to a PNG file and returns the file path.
+    The figure is rendered with the Agg canvas directly instead of pyplot, so rendering does not
+    depend on (or change) the matplotlib backend of the calling process.
+
+    Parameters:
+    - frame: Dictionary with the keys
+        'path': Output file.
+        'panels': List of keyword dictionaries for draw_map(), one per panel (side by side).
+        'figsize': Optional figure size.
+        'dpi': Optional resolution (default 100).
+        'suptitle': Optional title of the figure.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    panels = frame['panels']
+    figsize = frame.get('figsize', (12 if len(panels) == 1 else 7 * len(panels), 7 if len(panels) == 1 else 5))
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(nrows=1, ncols=len(panels), squeeze=False)
+    for ax, panel in zip(axes[0], panels):
+        draw_map(ax, **panel)
+    if frame.get('suptitle'):
+        fig.suptitle(frame['suptitle'])
+    fig.tight_layout()
+    directory = os.path.dirname(frame['path'])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fig.savefig(frame['path'], dpi=frame.get('dpi', 100))
+    return frame['path']
+
+
+def _warm_caches(projections):
+    """Builds the projections and their coastline layers, outlines and graticules."""
+    for projection, central_lon, resolution in projections:
+        _coastline_layers(projection, central_lon, resolution)
+        _map_outline(projection, central_lon, resolution)
+        _graticule(projection, central_lon, resolution)
+
+
+def _init_worker(projections):
+    """Initializes a worker process: headless backend and warm projection caches."""
+    use_headless_backend()
+    _warm_caches(projections)
+
+
+def render_frames(frames, processes=None):
+    """
+    Renders a batch of frames to PNG files, in parallel on a process pool.
+    Every worker builds each projection and its coastline layers once and reuses them for all frames.
+
+    Parameters:
+    - frames: List of frame dictionaries (see render_frame and the *_frame helpers).
+    - processes: Number of worker processes (default: number of CPUs). Use 1 to render in this process,
+                 which leaves the matplotlib backend of this process unchanged.
+
+    Returns:
+    - List of the written file paths, in the order of frames.
+    """
+    projections = sorted({(panel.get('projection', 'robin'), panel.get('central_lon', 180), panel.get('resolution', 'c'))
+                          for frame in frames for panel in frame['panels']
+                          if panel.get('projection', 'robin') is not None})
+    if processes == 1 or len(frames) <= 1:
+        _warm_caches(projections)
+        return [render_frame(frame) for frame in frames]
+
+    # Spread the frames evenly over the workers, with a few frames per task to reduce overhead
+    processes = processes or os.cpu_count()
+    chunksize = max(1, len(frames) // (4 * processes))
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(projections,)) as pool:
+        return list(pool.map(render_frame, frames, chunksize=chunksize))
+
+
+def trend_frame(trend_decade, path, vmin=-0.5, vmax=0.5, variable='SST', label='°C', **kwargs):
+    """
+    Returns a frame for a trend map, equivalent to trend_analysis.plot_trend_with_basemap.
+    """
+    panel = dict(data=trend_decade.load(), vmin=vmin, vmax=vmax, label=f'{label}/decade',
+                 title=f'Trend of {variable} per Grid Cell per Decade ({label}/decade)', **kwargs)
+    return {'path': path, 'panels': [panel]}
+
+
+def composite_frame(anom_positive, anom_negative, path, vmin=-1.5, vmax=1.5, label='°C', variable='SST',
+                    projection=None, **kwargs):
+    """
+    Returns a frame with the ENSO composites, equivalent to enso_functions.plot_composites.
+    """
+    panels = [dict(data=anom_positive.load(), vmin=vmin, vmax=vmax, label=label, projection=projection,
+                   title=f'{variable} Anomaly - Positive Niño3.4 (El Niño)', **kwargs),
+              dict(data=anom_negative.load(), vmin=vmin, vmax=vmax, label=label, projection=projection,
+                   title=f'{variable} Anomaly - Negative Niño3.4 (La Niña)', **kwargs)]
+    return {'path': path, 'panels': panels}
+
+
+def std_frame(analyzer, variable, path, vmin=0, vmax=10, cmap='plasma', projection=None, **kwargs):
+    """
+    Returns a frame with the standard deviation and the annual variability of a variable,
+    equivalent to TimeSeriesAnalyzer.plot_std_and_annual_var.
+    """
+    climatology = analyzer.compute_climatology()[variable]
+    original_std = analyzer.dataset[variable].std(dim='time')
+    annual_var = climatology.std(dim='month' if 'month' in climatology.dims else 'dayofyear')
+    panels = [dict(data=data.load(), vmin=vmin, vmax=vmax, cmap=cmap, projection=projection, title=title, **kwargs)
+              for data, title in [(original_std, 'Variability (Std)'), (annual_var, 'Annual Variability (Std)')]]
+    return {'path': path, 'panels': panels}
+
+
+def anomaly_frames(anomalies, directory, prefix='anomaly', vmin=-2, vmax=2, label='°C', variable='SST', **kwargs):
+    """
+    Returns one frame per time step of an anomaly field, e.g. for the frames of an animation.
+    Files are named <prefix>_<YYYY-MM-DD>.png.
+    """
+    # Load once, so lazy (dask or Zarr-cached) anomalies are not read or computed again per frame
+    anomalies = anomalies.compute()
+    frames = []
+    for time in anomalies['time'].values:
+        date = np.datetime_as_string(time, unit='D')
+        panel = dict(data=anomalies.sel(time=time), vmin=vmin, vmax=vmax, label=label,
+                     title=f'{variable} Anomaly {date}', contour_lines=False, **kwargs)
+        frames.append({'path': os.path.join(directory, f'{prefix}_{date}.png'), 'panels': [panel]})
+    return frames
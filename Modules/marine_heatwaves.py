@@ -0,0 +1,362 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# Standard normal quantiles used by the approximate (moment based) percentile climatology
+_NORMAL_QUANTILES = {50: 0.0, 75: 0.6744897501960817, 90: 1.2815515655446004,
+                     95: 1.6448536269514722, 99: 2.3263478740408408}
+
+
+def _leap_dayofyear(time):
+    """
+    Day of year on a 366-day calendar: in non-leap years all days from March 1 on are shifted
+    by one, so that a given date always has the same index and February 29 is day 60.
+    """
+    time = pd.DatetimeIndex(time)
+    shift = (~time.is_leap_year & (time.month > 2)).astype(int)
+    return np.asarray(time.dayofyear + shift)
+
+
+def _circular_window_sum(values, half_width, axis=-1):
+    """Sum over a window of 2*half_width+1 days along a circular day-of-year axis."""
+    return sum(np.roll(values, shift, axis=axis) for shift in range(-half_width, half_width + 1))
+
+
+def _circular_smooth(values, width, axis=-1):
+    """Running mean of the given width along a circular day-of-year axis."""
+    if width <= 1:
+        return values
+    return _circular_window_sum(values, width // 2, axis) / (2 * (width // 2) + 1)
+
+
+def _percentile_rows(samples, percentile):
+    """
+    Percentile along the last axis ignoring NaNs. np.nanpercentile falls back to a slow
+    row-by-row loop when NaNs are present, so rows without NaNs use np.percentile and only
+    partially missing rows use np.nanpercentile.
+    """
+    missing = np.isnan(samples)
+    any_missing = missing.any(-1)
+    result = np.percentile(np.where(missing, 0, samples), percentile, axis=-1)
+    partial = any_missing & ~missing.all(-1)
+    if partial.any():
+        result[partial] = np.nanpercentile(samples[partial], percentile, axis=-1)
+    result[missing.all(-1)] = np.nan
+    return result
+
+
+def _threshold_exact(values, doy, percentile, half_width):
+    """
+    Exact windowed percentile for every day of the year: all values within +/- half_width days
+    of that day (in all years) are pooled. values has the shape (..., time).
+    """
+    thresholds = np.empty(values.shape[:-1] + (366,))
+    for day in range(1, 367):
+        distance = np.abs(doy - day)
+        in_window = np.minimum(distance, 366 - distance) <= half_width
+        thresholds[..., day - 1] = _percentile_rows(values[..., in_window], percentile)
+    return thresholds
+
+
+def _doy_power_sums(values, doy, n_moments):
+    """
+    Counts the valid values and sums their powers 1..n_moments for every day of the year along
+    the first axis. Returns an array of shape (n_moments + 1, 366, ...).
+    """
+    valid = ~np.isnan(values)
+    # Sums of third and fourth powers lose too much precision in float32
+    x = np.where(valid, values, 0).astype(np.float64)
+    # Sort the time steps by day of the year, so every sum is one reduceat over a contiguous run
+    order = np.argsort(doy, kind='stable')
+    days, starts = np.unique(doy[order] - 1, return_index=True)
+    sums = np.zeros((n_moments + 1, 366) + values.shape[1:])
+    sums[0][days] = np.add.reduceat(valid[order].astype(np.float64), starts, axis=0)
+    x = x[order]
+    power = np.ones_like(x)
+    for k in range(1, n_moments + 1):
+        power *= x
+        sums[k][days] = np.add.reduceat(power, starts, axis=0)
+    return sums
+
+
+def _doy_power_sums_block(values, doy, n_moments):
+    """_doy_power_sums for one dask block, with a leading axis of length 1 for the time block."""
+    return _doy_power_sums(values, doy.ravel(), n_moments)[None]
+
+
+def daily_climatology(sst, percentile=90, window_half_width=5, smooth_width=31, method='exact'):
+    """
+    Computes the seasonal climatology and the percentile threshold for every day of the year
+    following Hobday et al. (2016): values within +/- window_half_width days of each day of the
+    year are pooled over all years, and both curves are smoothed with a smooth_width-day running mean.
+
+    Parameters:
+    - sst: xarray.DataArray with daily data (time, ...). Dask arrays are processed chunk by chunk over space.
+    - percentile: Percentile of the threshold (default 90).
+    - window_half_width: Half width of the pooling window in days (default 5, i.e. 11 days).
+    - smooth_width: Width of the running mean in days (default 31).
+    - method: 'exact' computes windowed percentiles (time must fit into memory per spatial chunk).
+              'approximate' estimates the percentile from the windowed mean, variance, skewness and
+              kurtosis with the Cornish-Fisher expansion. It only needs day-of-year sums of powers,
+              which are accumulated in one streaming pass that also works with chunks along time.
+
+    Returns:
+    - xarray.Dataset with 'seas' (climatological mean) and 'thresh' (percentile threshold)
+      on the dimension 'dayofyear' (1-366, with February 29 as day 60).
+    """
+    doy = _leap_dayofyear(sst['time'].values)
+    n_moments = 4 if method == 'approximate' else 1
+    space_dims = [dim for dim in sst.dims if dim != 'time']
+    data = sst.transpose('time', *space_dims)
+
+    # Counts and sums of powers per day of the year, accumulated block by block (one task per
+    # chunk, also along time for dask) and added up afterwards
+    if data.chunks is None:
+        sums = _doy_power_sums(data.values, doy, n_moments)
+    else:
+        import dask.array as dsa
+        ones = (1,) * len(space_dims)
+        doy_blocks = dsa.from_array(doy.reshape((-1,) + ones), chunks=(data.chunks[0],) + tuple((1,) for _ in ones))
+        parts = dsa.map_blocks(_doy_power_sums_block, data.data, doy_blocks, n_moments=n_moments, new_axis=[1, 2],
+                               chunks=((1,) * len(data.chunks[0]), (n_moments + 1,), (366,)) + data.chunks[1:],
+                               dtype=np.float64)
+        sums = parts.sum(axis=0)
+    sums = xr.DataArray(sums, dims=('power', 'dayofyear', *space_dims),
+                        coords={'dayofyear': np.arange(1, 367), **{dim: data[dim] for dim in space_dims}})
+
+    # Pool the sums over the window around each day of the year
+    # (per block with numpy, np.roll on dask arrays would create a task per shift and chunk)
+    pooled = xr.apply_ufunc(_circular_window_sum, sums, kwargs={'half_width': window_half_width},
+                            input_core_dims=[['dayofyear']], output_core_dims=[['dayofyear']],
+                            dask='parallelized', output_dtypes=[float])
+    pooled = [pooled.isel(power=power, drop=True) for power in range(n_moments + 1)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        count = pooled[0].where(pooled[0] > 0)
+        mean = pooled[1] / count
+
+    if method == 'exact':
+        thresh = xr.apply_ufunc(
+            _threshold_exact, sst, doy,
+            kwargs={'percentile': percentile, 'half_width': window_half_width},
+            input_core_dims=[['time'], ['time']], output_core_dims=[['dayofyear']],
+            dask='parallelized', output_dtypes=[float],
+            dask_gufunc_kwargs={'output_sizes': {'dayofyear': 366}, 'allow_rechunk': True},
+        ).assign_coords(dayofyear=np.arange(1, 367))
+    elif method == 'approximate':
+        if percentile not in _NORMAL_QUANTILES:
+            raise ValueError(f"The approximate method supports the percentiles {sorted(_NORMAL_QUANTILES)}.")
+        z = _NORMAL_QUANTILES[percentile]
+        # Central moments from the raw moments
+        m2 = pooled[2] / count - mean**2
+        m3 = pooled[3] / count - 3 * mean * pooled[2] / count + 2 * mean**3
+        m4 = pooled[4] / count - 4 * mean * pooled[3] / count + 6 * mean**2 * pooled[2] / count - 3 * mean**4
+        std = np.sqrt(m2.clip(min=0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            skew = (m3 / std**3).fillna(0)
+            excess_kurtosis = (m4 / m2**2 - 3).fillna(0)
+        # Cornish-Fisher expansion of the quantile up to the kurtosis terms
+        w = (z + (z**2 - 1) * skew / 6 + (z**3 - 3 * z) * excess_kurtosis / 24
+             - (2 * z**3 - 5 * z) * skew**2 / 36)
+        thresh = mean + std * w
+    else:
+        raise ValueError("method must be 'exact' or 'approximate'.")
+
+    # Move dayofyear to the front, like the climatology of TimeSeriesAnalyzer
+    seas = xr.apply_ufunc(_circular_smooth, mean, kwargs={'width': smooth_width},
+                          input_core_dims=[['dayofyear']], output_core_dims=[['dayofyear']],
+                          dask='parallelized', output_dtypes=[float])
+    thresh = xr.apply_ufunc(_circular_smooth, thresh, kwargs={'width': smooth_width},
+                            input_core_dims=[['dayofyear']], output_core_dims=[['dayofyear']],
+                            dask='parallelized', output_dtypes=[float])
+    climatology = xr.Dataset({'seas': seas, 'thresh': thresh}).transpose('dayofyear', ...)
+    climatology.attrs['description'] = f'Seasonal climatology and {percentile}th percentile threshold ({method}).'
+    return climatology
+
+
+def find_events(exceed, min_duration=5, max_gap=2):
+    """
+    Finds runs of consecutive True values along the last axis of a 2D boolean array
+    (cells x time), without a Python loop over cells or time steps.
+    Runs shorter than min_duration are dropped first; then runs separated by at most
+    max_gap days are joined into one event (Hobday et al., 2016).
+
+    Returns:
+    - cell, start, end: Integer arrays with the cell index and the first and last time index of each event.
+    """
+    n_cells, n_time = exceed.shape
+    padded = np.zeros((n_cells, n_time + 2), dtype=np.int8)
+    padded[:, 1:-1] = exceed
+    change = np.diff(padded, axis=1)
+    # Runs start where the series switches from False to True and end where it switches back
+    cell, start = np.nonzero(change == 1)
+    _, end = np.nonzero(change == -1)
+    end = end - 1
+
+    keep = (end - start + 1) >= min_duration
+    cell, start, end = cell[keep], start[keep], end[keep]
+    if cell.size == 0:
+        return cell, start, end
+
+    # Join events of the same cell separated by short gaps
+    new_event = np.ones(cell.size, dtype=bool)
+    new_event[1:] = (cell[1:] != cell[:-1]) | (start[1:] - end[:-1] - 1 > max_gap)
+    first = np.flatnonzero(new_event)
+    last = np.append(first[1:], cell.size) - 1
+    return cell[first], start[first], end[last]
+
+
+def _event_statistics(values, seas, doy_index, cell, start, end):
+    """
+    Computes duration, peak time index and maximum, mean and cumulative intensity of each event
+    from the anomaly relative to the seasonal climatology. values has the shape (time, cells) and
+    seas the shape (dayofyear, cells); the anomaly is only computed for the days of the events.
+    Days within an event that are missing (only possible in joined gaps) do not contribute.
+    """
+    duration = end - start + 1
+    if cell.size == 0:
+        empty = np.zeros(0)
+        return duration, start, empty, empty, empty
+    # Gather all event days into one flat array, ordered by event
+    offsets = np.concatenate([[0], np.cumsum(duration)[:-1]])
+    event = np.repeat(np.arange(cell.size), duration)
+    day = np.repeat(start, duration) + np.arange(duration.sum()) - np.repeat(offsets, duration)
+    cells = np.repeat(cell, duration)
+    values = values[day, cells].astype(float) - seas[doy_index[day], cells]
+
+    cumulative = np.bincount(event, weights=np.nan_to_num(values), minlength=cell.size)
+    maximum = np.maximum.reduceat(np.where(np.isnan(values), -np.inf, values), offsets)
+    # The peak is the first day of each event that reaches its maximum
+    at_max = np.flatnonzero(values == maximum[event])
+    _, first_hit = np.unique(event[at_max], return_index=True)
+    peak = day[at_max[first_hit]]
+    return duration, peak, maximum, cumulative / duration, cumulative
+
+
+_MAP_NAMES = ['count', 'duration_mean', 'days_total', 'intensity_max', 'intensity_mean', 'intensity_cumulative']
+
+
+def _detect_block(values, seas, thresh, doy_index, min_duration, max_gap):
+    """
+    Detects the events in one spatial block with the complete time series (time, ...), given
+    the seasonal climatology and threshold of the block (dayofyear, ...).
+
+    Returns:
+    - maps: Dictionary of event statistics per grid cell, with the spatial shape of the block.
+    - events: Dictionary of arrays with one entry per event; 'cell' is the flat index within the block.
+    """
+    shape = values.shape[1:]
+    # Keep the block in its layout (time, cells) and its dtype
+    values = np.asarray(values).reshape(values.shape[0], -1)
+    seas = np.asarray(seas).reshape(366, -1)
+    thresh = np.asarray(thresh).reshape(366, -1)
+    n_cells = values.shape[1]
+
+    # Compare the time steps of each day of the year with its threshold, instead of expanding
+    # the threshold to the full length of the time series
+    exceed = np.empty(values.shape, dtype=bool)
+    order = np.argsort(doy_index, kind='stable')
+    days, first = np.unique(doy_index[order], return_index=True)
+    for day, steps in zip(days, np.split(order, first[1:])):
+        exceed[steps] = values[steps] > thresh[day]
+
+    cell, start, end = find_events(exceed.T, min_duration, max_gap)
+    duration, peak, maximum, mean, cumulative = _event_statistics(values, seas, doy_index, cell, start, end)
+
+    counts = np.bincount(cell, minlength=n_cells)
+    maps = {
+        'count': counts.astype(float),
+        'days_total': np.bincount(cell, weights=duration, minlength=n_cells),
+        'intensity_cumulative': np.bincount(cell, weights=cumulative, minlength=n_cells),
+        'intensity_max': np.full(n_cells, np.nan),
+    }
+    np.fmax.at(maps['intensity_max'], cell, maximum)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        maps['duration_mean'] = maps['days_total'] / counts
+        maps['intensity_mean'] = np.bincount(cell, weights=mean, minlength=n_cells) / counts
+    land = np.isnan(values).all(axis=0)
+    maps = {name: np.where(land, np.nan, maps[name]).reshape(shape) for name in _MAP_NAMES}
+    events = {'cell': cell, 'start': start, 'end': end, 'peak': peak, 'duration': duration,
+              'intensity_max': maximum, 'intensity_mean': mean, 'intensity_cumulative': cumulative}
+    return maps, events
+
+
+def detect_marine_heatwaves(sst, climatology=None, percentile=90, min_duration=5, max_gap=2,
+                            method='exact', climatology_period=None):
+    """
+    Detects marine heatwaves in daily SST at every grid cell (Hobday et al., 2016): periods of at
+    least min_duration days above the seasonally varying percentile threshold, where events with
+    gaps of at most max_gap days are joined.
+
+    sst is rechunked to a single chunk along time and spatial chunks of dask's default chunk size
+    (array.chunk-size in the dask config). The detection runs once per spatial chunk and all chunks
+    are computed together, so each chunk of the data is read only once. Without a baseline period,
+    the climatology is computed in the same pass.
+
+    Parameters:
+    - sst: xarray.DataArray with daily data (time, lat, lon) or (time, ...).
+    - climatology: Optional output of daily_climatology; computed from sst if not given.
+    - percentile: Percentile of the threshold (default 90).
+    - min_duration: Minimum duration of an event in days (default 5).
+    - max_gap: Maximum gap in days between events that are joined (default 2).
+    - method: 'exact' or 'approximate' percentile climatology (see daily_climatology).
+    - climatology_period: Optional (start, end) of the baseline period, e.g. ('1991', '2020').
+
+    Returns:
+    - maps: xarray.Dataset with, per grid cell, the number of events, their mean duration, the total
+      number of heatwave days and the maximum, mean and total cumulative intensity.
+    - events: pandas.DataFrame with one row per event (grid cell coordinates, start, end and peak date,
+      duration, maximum, mean and cumulative intensity in units of sst).
+    """
+    import dask
+
+    if np.median(np.diff(sst['time'].values)) != np.timedelta64(1, 'D'):
+        raise ValueError("Marine heatwave detection requires daily data.")
+    space_dims = [dim for dim in sst.dims if dim != 'time']
+    # One chunk along time, and spatial chunks of dask's default chunk size, so that a block holds
+    # the complete time series of a limited number of grid cells
+    data = sst.transpose('time', *space_dims).chunk({'time': -1, **{dim: 'auto' for dim in space_dims}})
+    if climatology is None:
+        baseline = data.sel(time=slice(*climatology_period)) if climatology_period is not None else data
+        climatology = daily_climatology(baseline, percentile=percentile, method=method)
+
+    # Give the climatology the spatial chunks of the data, so block i of both covers the same cells
+    space_chunks = dict(zip(space_dims, data.chunks[1:]))
+    seas, thresh = (climatology[name].transpose('dayofyear', *space_dims).chunk({'dayofyear': -1, **space_chunks})
+                    for name in ('seas', 'thresh'))
+
+    times = data['time'].values
+    doy_index = _leap_dayofyear(times) - 1
+    blocks = list(np.ndindex(*[len(chunks) for chunks in data.chunks[1:]]))
+    data_blocks, seas_blocks, thresh_blocks = (array.data.to_delayed()[0] for array in (data, seas, thresh))
+    detect = dask.delayed(_detect_block, pure=True)
+    results = dask.compute(*[detect(data_blocks[block], seas_blocks[block], thresh_blocks[block],
+                                    doy_index, min_duration, max_gap) for block in blocks])
+
+    offsets = [np.concatenate([[0], np.cumsum(chunks)[:-1]]) for chunks in data.chunks[1:]]
+    maps = {name: np.full(data.shape[1:], np.nan) for name in _MAP_NAMES}
+    tables = []
+    for block, (block_maps, block_events) in zip(blocks, results):
+        start = [offsets[axis][index] for axis, index in enumerate(block)]
+        region = tuple(slice(first, first + size) for first, size in zip(start, block_maps['count'].shape))
+        for name in _MAP_NAMES:
+            maps[name][region] = block_maps[name]
+
+        # Grid cell coordinates of the events from their position within the block
+        position = np.unravel_index(block_events.pop('cell'), block_maps['count'].shape)
+        table = {dim: data[dim].values[first + index] for dim, first, index in zip(space_dims, start, position)}
+        table.update({'time_start': times[block_events.pop('start')], 'time_end': times[block_events.pop('end')],
+                      'time_peak': times[block_events.pop('peak')]})
+        table.update(block_events)
+        tables.append(pd.DataFrame(table))
+
+    coords = {dim: data[dim] for dim in space_dims}
+    maps = xr.Dataset({name: xr.DataArray(values, coords=coords, dims=space_dims) for name, values in maps.items()})
+    maps['count'].attrs['long_name'] = 'Number of marine heatwaves'
+    maps['duration_mean'].attrs['long_name'] = 'Mean duration of marine heatwaves (days)'
+    maps['days_total'].attrs['long_name'] = 'Total number of marine heatwave days'
+    maps['intensity_max'].attrs['long_name'] = 'Maximum intensity (anomaly from the climatology)'
+    maps['intensity_mean'].attrs['long_name'] = 'Mean intensity of marine heatwaves'
+    maps['intensity_cumulative'].attrs['long_name'] = 'Total cumulative intensity (anomaly x days)'
+    events = pd.concat(tables, ignore_index=True)
+    return maps, events
@@ -0,0 +1,207 @@
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+
+# Number of explicitly stored mantissa bits of IEEE floating point numbers
+_MANTISSA_BITS = {np.dtype('float32'): 23, np.dtype('float64'): 52}
+_UINT_TYPES = {np.dtype('float32'): np.uint32, np.dtype('float64'): np.uint64}
+
+# Dimension names treated as horizontal (spatial) by timeseries_chunks
+_SPATIAL_DIMS = ('lat', 'latitude', 'lon', 'longitude', 'x', 'y', 'rlat', 'rlon')
+
+
+def bitround(values, keepbits):
+    """
+    Rounds floating point values to keepbits mantissa bits (round to nearest, ties to even).
+    The discarded bits become zero, which compresses much better while the relative error stays
+    below 2**-(keepbits+1). NaNs are preserved.
+
+    Parameters:
+    - values: numpy array of float32 or float64.
+    - keepbits: Number of mantissa bits to keep (e.g. 7 keeps about 2-3 significant digits).
+
+    Returns:
+    - Rounded numpy array of the same dtype.
+    """
+    values = np.ascontiguousarray(values)
+    mantissa_bits = _MANTISSA_BITS[values.dtype]
+    if keepbits >= mantissa_bits:
+        return values
+    uint = _UINT_TYPES[values.dtype]
+    drop = mantissa_bits - keepbits
+    bits = values.view(uint)
+    # Add half of the dropped range (minus one) plus the lowest kept bit, then cut off the dropped bits
+    half = uint((1 << (drop - 1)) - 1)
+    rounded = (bits + half + ((bits >> uint(drop)) & uint(1))) & ~uint((1 << drop) - 1)
+    return np.where(np.isnan(values), values, rounded.view(values.dtype))
+
+
+def packing_encoding(data, nbits=16):
+    """
+    Computes scale_factor/add_offset packing of a variable into nbits-bit integers (8, 16 or 32).
+    The lowest integer is reserved as _FillValue for missing values.
+
+    Parameters:
+    - data: xarray.DataArray to pack.
+    - nbits: Size of the packed integers.
+
+    Returns:
+    - Encoding dictionary for the variable.
+    """
+    if data.chunks is not None:
+        import dask
+        # Compute both in one pass over the data
+        vmin, vmax = dask.compute(data.min(), data.max())
+    else:
+        vmin, vmax = data.min(), data.max()
+    vmin, vmax = float(vmin), float(vmax)
+    n_values = 2**nbits - 2  # values available apart from _FillValue
+    scale_factor = (vmax - vmin) / n_values if vmax > vmin else 1.0
+    return {'dtype': f'int{nbits}',
+            'scale_factor': scale_factor,
+            'add_offset': (vmax + vmin) / 2,
+            '_FillValue': -2**(nbits - 1)}
+
+
+def timeseries_chunks(data, target_mb=4):
+    """
+    Chooses chunks for fast access to time series at single grid cells: every chunk holds the
+    complete time axis of a small spatial tile, about target_mb in size. The spatial dimensions
+    are recognized by name (lat/latitude, lon/longitude, x, y, rlat, rlon); other dimensions
+    (e.g. depth) get chunks of size 1.
+
+    Parameters:
+    - data: xarray.DataArray.
+    - target_mb: Approximate uncompressed chunk size in MB.
+
+    Returns:
+    - Dictionary of chunk sizes per dimension.
+    """
+    if 'time' not in data.dims:
+        # Maps (e.g. climatology per month, trends) are read as a whole
+        return dict(data.sizes)
+    itemsize = data.dtype.itemsize
+    nt = data.sizes['time']
+    spatial = [dim for dim in data.dims if dim in _SPATIAL_DIMS]
+    # Number of grid cells per chunk, split evenly over the spatial dimensions
+    cells = max(1, int(target_mb * 1024**2 / (nt * itemsize)))
+    side = max(1, int(cells ** (1 / max(1, len(spatial)))))
+    chunks = {}
+    for dim in data.dims:
+        if dim == 'time':
+            chunks[dim] = min(nt, max(1, int(target_mb * 1024**2 / itemsize)))
+        elif dim in spatial:
+            chunks[dim] = min(data.sizes[dim], side)
+        else:
+            chunks[dim] = 1
+    return chunks
+
+
+def _stored_size(path):
+    """Returns the size of a file or of all files in a directory (Zarr store) in bytes."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def write_product(product, filepath, file_format=None, compression='zlib', complevel=4, chunks='timeseries',
+                  dtype='float32', keepbits=None, pack_bits=None, group=None, mode='w'):
+    """
+    Writes a derived product (anomalies, climatology, amplitude, trends, ...) to NetCDF4 or Zarr
+    with chunking, compression and optional lossy precision control.
+
+    Parameters:
+    - product: xarray.Dataset or xarray.DataArray to write.
+    - filepath: Output path. The format is taken from the extension (.nc or .zarr) unless given.
+    - file_format: 'netcdf' or 'zarr'.
+    - compression: 'zlib', 'zstd' or None.
+    - complevel: Compression level (1-9 for zlib, 1-22 for zstd).
+    - chunks: 'timeseries' (complete time axis per chunk, see timeseries_chunks),
+              a dictionary of chunk sizes per dimension, or None for the library defaults.
+    - dtype: Floating point type to store (default 'float32'), None keeps the type of the data.
+    - keepbits: Optional number of mantissa bits to keep (bit-rounding, see bitround).
+    - pack_bits: Optional integer size (8, 16 or 32) for scale/offset packing. Overrides dtype and keepbits.
+    - group: Optional group (NetCDF) or subgroup (Zarr) to write into, e.g. 'climatology'.
+    - mode: 'w' to overwrite the file, 'a' to add a group to an existing file.
+
+    Returns:
+    - Dictionary with the uncompressed and stored size in bytes, the compression ratio,
+      the write time in seconds and the write throughput in MB/s.
+    """
+    ds = product.to_dataset(name=product.name or 'values') if isinstance(product, xr.DataArray) else product
+    if file_format is None:
+        file_format = 'zarr' if filepath.rstrip('/').endswith('.zarr') else 'netcdf'
+    if file_format not in ('netcdf', 'zarr'):
+        raise ValueError("file_format must be 'netcdf' or 'zarr'.")
+    if compression not in ('zlib', 'zstd', None):
+        raise ValueError("compression must be 'zlib', 'zstd' or None.")
+
+    uncompressed = ds.nbytes
+    ds = ds.copy()
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        var.encoding = {}
+        var_encoding = {}
+        if np.issubdtype(var.dtype, np.floating):
+            if pack_bits is not None:
+                var_encoding.update(packing_encoding(var, pack_bits))
+            else:
+                if dtype is not None:
+                    var = var.astype(dtype)
+                if keepbits is not None:
+                    var = xr.apply_ufunc(bitround, var, kwargs={'keepbits': keepbits},
+                                         dask='parallelized', output_dtypes=[var.dtype], keep_attrs=True)
+                ds[name] = var
+
+        var_chunks = timeseries_chunks(ds[name]) if chunks == 'timeseries' else chunks
+        if var_chunks is not None:
+            var_chunks = {dim: var_chunks.get(dim, size) for dim, size in ds[name].sizes.items()}
+            if ds[name].chunks is not None:
+                # Zarr requires the dask chunks to match the chunks on disk
+                ds[name] = ds[name].chunk(var_chunks)
+            chunk_shape = tuple(var_chunks[dim] for dim in ds[name].dims)
+
+        if file_format == 'netcdf':
+            if compression == 'zlib':
+                var_encoding.update({'zlib': True, 'complevel': complevel, 'shuffle': True})
+            elif compression == 'zstd':
+                var_encoding.update({'compression': 'zstd', 'complevel': complevel, 'shuffle': True})
+            if var_chunks is not None and ds[name].ndim > 0:
+                var_encoding['chunksizes'] = chunk_shape
+        else:
+            import numcodecs
+            if compression == 'zlib':
+                var_encoding['compressor'] = numcodecs.Zlib(level=complevel)
+            elif compression == 'zstd':
+                var_encoding['compressor'] = numcodecs.Zstd(level=complevel)
+            else:
+                var_encoding['compressor'] = None
+            if var_chunks is not None and ds[name].ndim > 0:
+                var_encoding['chunks'] = chunk_shape
+        encoding[name] = var_encoding
+
+    for var in ds.coords.values():
+        var.encoding = {}
+
+    # When adding a group to an existing file, only the added bytes count for the compression ratio
+    size_before = _stored_size(filepath) if mode == 'a' and os.path.exists(filepath) else 0
+    t0 = time.perf_counter()
+    if file_format == 'netcdf':
+        ds.to_netcdf(filepath, mode=mode, group=group, engine='netcdf4', encoding=encoding)
+    else:
+        ds.to_zarr(filepath, mode='w' if mode == 'w' else 'a', group=group, encoding=encoding, consolidated=True)
+    seconds = time.perf_counter() - t0
+
+    stored = _stored_size(filepath) - size_before
+    return {
+        'path': filepath,
+        'group': group,
+        'uncompressed_bytes': uncompressed,
+        'stored_bytes': stored,
+        'compression_ratio': uncompressed / stored if stored else float('nan'),
+        'seconds': seconds,
+        'throughput_mb_s': uncompressed / 1024**2 / seconds if seconds > 0 else float('nan'),
+    }
@@ -0,0 +1,471 @@
+"""
+Declarative batch pipeline runner.
+
+Reads a pipeline specification (TOML or YAML), builds a dependency graph of the analysis
+functions of this course and runs independent stages concurrently. Stage outputs are stored as
+Zarr in the work directory, except for open_dataset stages: they only store the resolved file
+list and options, and their files are reopened lazily by the stages that use them. A stage is
+skipped if its function, parameters and inputs are unchanged since its last successful run,
+so a failed run resumes where it stopped.
+
+    python Modules/pipeline.py nightly.toml
+    python Modules/pipeline.py nightly.toml --workers 8 --force anomalies
+
+Example specification (TOML):
+
+    workdir = "../Data/pipeline"
+
+    [stages.sst]
+    function = "open_dataset"
+    params = { paths = "../Data/SST/*.nc", variables = ["sst"], chunks = { time = -1 } }
+
+    [stages.anomalies]
+    function = "anomalies"
+    inputs = { dataset = "sst" }
+
+    [stages.trend]
+    function = "trend"
+    inputs = { data = "anomalies.sst" }
+
+    [stages.nino34]
+    function = "nino34"
+    inputs = { sst_anom_detrended = "anomalies.sst" }
+
+    [stages.composites]
+    function = "composites"
+    inputs = { anom_detrended = "anomalies.sst", nino34_index = "nino34" }
+
+Inputs refer to the output of another stage ("stage") or to one variable of it ("stage.variable").
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import importlib
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import xarray as xr
+
+from result_cache import result_to_dataset, dataset_to_result, prepare_for_zarr
+
+# Directory of the Session 2 modules (trend_analysis, enso_functions) used by some stage functions.
+# main() adds it to sys.path; callers of run_pipeline have to make these modules importable themselves.
+SESSION2_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Session2_DataHandling')
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = 'pipeline_state.json'
+_META_FILE = '.pipeline_meta.json'
+
+
+# ---------------------------------------------------------------------------
+# Stage functions
+# ---------------------------------------------------------------------------
+
+def open_dataset(paths, variables=None, chunks=None):
+    """
+    Opens one or several NetCDF files (glob patterns allowed) as one dataset.
+
+    Parameters:
+    - paths: File path, glob pattern or list of those.
+    - variables: Optional list of variables to keep.
+    - chunks: Dask chunks passed to xr.open_mfdataset (default: one chunk per file).
+    """
+    files = _expand_paths(paths)
+    ds = xr.open_mfdataset(files, chunks=chunks, combine='by_coords')
+    return ds[variables] if variables is not None else ds
+
+
+def climatology(dataset):
+    """Climatology of all variables (TimeSeriesAnalyzer.compute_climatology)."""
+    from timeseries_analyzer import TimeSeriesAnalyzer
+    return TimeSeriesAnalyzer(dataset).compute_climatology()
+
+
+def anomalies(dataset):
+    """Detrended anomalies of all variables (TimeSeriesAnalyzer.compute_anomalies_and_detrend)."""
+    from timeseries_analyzer import TimeSeriesAnalyzer
+    return TimeSeriesAnalyzer(dataset).compute_anomalies_and_detrend()
+
+
+def annual_amplitude(dataset):
+    """Annual amplitude of all variables (TimeSeriesAnalyzer.compute_annual_amplitude)."""
+    from timeseries_analyzer import TimeSeriesAnalyzer
+    return TimeSeriesAnalyzer(dataset).compute_annual_amplitude()
+
+
+def trend(data):
+    """Trend per decade for each grid cell (trend_analysis.calculate_trend_per_decade)."""
+    from trend_analysis import calculate_trend_per_decade
+    return calculate_trend_per_decade(data)
+
+
+def nino34(sst_anom_detrended):
+    """Niño3.4 index (enso_functions.calculate_nino34_index)."""
+    from enso_functions import calculate_nino34_index
+    return calculate_nino34_index(sst_anom_detrended)
+
+
+def composites(anom_detrended, nino34_index):
+    """ENSO composites (enso_functions.calculate_composites) as a dataset with 'positive' and 'negative'."""
+    from enso_functions import calculate_composites
+    anom_positive, anom_negative = calculate_composites(anom_detrended, nino34_index)
+    return xr.Dataset({'positive': anom_positive, 'negative': anom_negative})
+
+
+def ekman(u, v, rho_air=1.293, Cd=1.3e-3, rho_water=1025):
+    """Ekman products from wind velocities (ekman_dynamics.compute_ekman_properties)."""
+    from ekman_dynamics import compute_ekman_properties
+    products = compute_ekman_properties(u, v, rho_air, Cd, rho_water)
+    return xr.Dataset(dict(zip(['curl_tau', 'M_u', 'M_v', 'mean_Ekman', 'w_E'], products)))
+
+
+def ekman_from_stress(tau_u, tau_v, rho_water=1025):
+    """Ekman products from wind stress (ekman_dynamics.compute_ekman_properties_from_stress)."""
+    from ekman_dynamics import compute_ekman_properties_from_stress
+    products = compute_ekman_properties_from_stress(tau_u, tau_v, rho_water)
+    return xr.Dataset(dict(zip(['curl_tau', 'M_u', 'M_v', 'mean_Ekman', 'w_E'], products)))
+
+
+# Functions that can be used by name in a specification. Other functions can be
+# referenced as "module:function" (the module must be importable).
+FUNCTIONS = {
+    'open_dataset': open_dataset,
+    'climatology': climatology,
+    'anomalies': anomalies,
+    'annual_amplitude': annual_amplitude,
+    'trend': trend,
+    'nino34': nino34,
+    'composites': composites,
+    'ekman': ekman,
+    'ekman_from_stress': ekman_from_stress,
+}
+
+# Stages that only open source files. Instead of copying the data into the work directory,
+# their resolved parameters are stored and the files are reopened when the output is loaded.
+SOURCE_FUNCTIONS = ('open_dataset',)
+
+
+def _resolve_function(name):
+    """Returns the function registered under name, or imports it from 'module:function'."""
+    if name in FUNCTIONS:
+        return FUNCTIONS[name]
+    if ':' not in name:
+        raise ValueError(f"Unknown function '{name}'. Use one of {sorted(FUNCTIONS)} or 'module:function'.")
+    module, function = name.split(':', 1)
+    return getattr(importlib.import_module(module), function)
+
+
+def _expand_paths(paths):
+    """Expands a path, glob pattern or list of those into a sorted list of files."""
+    patterns = [paths] if isinstance(paths, str) else list(paths)
+    files = sorted({f for pattern in patterns for f in glob.glob(os.path.expanduser(pattern))})
+    if not files:
+        raise FileNotFoundError(f"No files match {paths}.")
+    return files
+
+
+# ---------------------------------------------------------------------------
+# Specification
+# ---------------------------------------------------------------------------
+
+def load_spec(filepath):
+    """
+    Reads a pipeline specification from a TOML or YAML file and checks it.
+    Relative paths (workdir and 'paths' parameters) are resolved relative to the specification file.
+
+    Returns:
+    - Dictionary with 'workdir', 'workers', 'executor' and 'stages'.
+    """
+    if filepath.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("Reading YAML specifications requires PyYAML (pip install pyyaml).")
+        with open(filepath) as f:
+            spec = yaml.safe_load(f)
+    else:
+        import tomllib
+        with open(filepath, 'rb') as f:
+            spec = tomllib.load(f)
+
+    base = os.path.dirname(os.path.abspath(filepath))
+    spec['workdir'] = os.path.join(base, spec.get('workdir', 'pipeline_output'))
+    spec.setdefault('workers', None)
+    spec.setdefault('executor', 'process')
+
+    stages = spec.get('stages') or {}
+    if not stages:
+        raise ValueError("The specification does not define any stages.")
+    for name, stage in stages.items():
+        if '.' in name:
+            raise ValueError(f"Stage name '{name}' must not contain '.'.")
+        if 'function' not in stage:
+            raise ValueError(f"Stage '{name}' has no function.")
+        stage.setdefault('inputs', {})
+        stage.setdefault('params', {})
+        if 'paths' in stage['params']:
+            paths = stage['params']['paths']
+            resolve = lambda p: os.path.join(base, os.path.expanduser(p))
+            stage['params']['paths'] = resolve(paths) if isinstance(paths, str) else [resolve(p) for p in paths]
+        for argument, reference in stage['inputs'].items():
+            if reference.split('.', 1)[0] not in stages:
+                raise ValueError(f"Input '{argument}' of stage '{name}' refers to unknown stage '{reference}'.")
+    _topological_order(stages)  # raises on cycles
+    return spec
+
+
+def _dependencies(stage):
+    """Returns the names of the stages a stage depends on."""
+    return {reference.split('.', 1)[0] for reference in stage['inputs'].values()}
+
+
+def _topological_order(stages):
+    """Returns the stage names so that every stage comes after its dependencies."""
+    order, done, visiting = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"The pipeline has a dependency cycle involving stage '{name}'.")
+        visiting.add(name)
+        for dependency in sorted(_dependencies(stages[name])):
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+def stage_keys(stages):
+    """
+    Computes a key for every stage from its function, its parameters, the source files it reads
+    (paths, mtimes and sizes) and the keys of the stages it depends on. The key changes whenever
+    anything that influences the output of the stage changes.
+    """
+    keys = {}
+    for name in _topological_order(stages):
+        stage = stages[name]
+        sources = []
+        if 'paths' in stage['params']:
+            sources = [(f, os.path.getmtime(f), os.path.getsize(f)) for f in _expand_paths(stage['params']['paths'])]
+        inputs = {argument: (reference, keys[reference.split('.', 1)[0]])
+                  for argument, reference in stage['inputs'].items()}
+        content = json.dumps([stage['function'], stage['params'], inputs, sources], sort_keys=True, default=str)
+        keys[name] = hashlib.sha1(content.encode()).hexdigest()
+    return keys
+
+
+# ---------------------------------------------------------------------------
+# Execution
+# ---------------------------------------------------------------------------
+
+def _output_path(workdir, name):
+    return os.path.join(workdir, f'{name}.zarr')
+
+
+def _source_path(workdir, name):
+    return os.path.join(workdir, f'{name}.source.json')
+
+
+def _has_output(workdir, name):
+    """Returns True if a complete output (Zarr store or source reference) of the stage exists."""
+    return (os.path.exists(_source_path(workdir, name))
+            or os.path.exists(os.path.join(_output_path(workdir, name), _META_FILE)))
+
+
+def load_output(workdir, reference):
+    """
+    Loads the stored output of a stage ("stage") or one variable of it ("stage.variable").
+    Outputs of open_dataset stages are reopened lazily from their source files.
+    """
+    name, _, variable = reference.partition('.')
+    source = _source_path(workdir, name)
+    if os.path.exists(source):
+        with open(source) as f:
+            result = open_dataset(**json.load(f))
+    else:
+        path = _output_path(workdir, name)
+        with open(os.path.join(path, _META_FILE)) as f:
+            meta = json.load(f)
+        result = dataset_to_result(xr.open_zarr(path), meta)
+    return result[variable] if variable else result
+
+
+def _store_output(workdir, name, result):
+    """Writes the output of a stage to Zarr, replacing a previous output only when complete."""
+    ds, meta = result_to_dataset(result)
+    path = _output_path(workdir, name)
+    tmp_path = f'{path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    prepare_for_zarr(ds).to_zarr(tmp_path, mode='w', consolidated=True)
+    with open(os.path.join(tmp_path, _META_FILE), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    if os.path.exists(_source_path(workdir, name)):
+        os.remove(_source_path(workdir, name))
+
+
+def _store_source(workdir, name, params):
+    """
+    Stores the parameters of an open_dataset stage with the file list resolved, so that its
+    output is reopened from exactly these files. Removes a Zarr copy from earlier versions.
+    """
+    params = dict(params, paths=_expand_paths(params['paths']))
+    path = _source_path(workdir, name)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(params, f, indent=2)
+    os.replace(f'{path}.tmp', path)
+    shutil.rmtree(_output_path(workdir, name), ignore_errors=True)
+
+
+def run_stage(workdir, name, stage):
+    """
+    Runs one stage: loads its inputs, calls its function and stores the output.
+    open_dataset stages only store their resolved parameters (see SOURCE_FUNCTIONS).
+    Executed in a worker process or thread. Returns the wall time in seconds.
+    """
+    t0 = time.perf_counter()
+    if stage['function'] in SOURCE_FUNCTIONS:
+        _store_source(workdir, name, stage['params'])
+        return time.perf_counter() - t0
+    function = _resolve_function(stage['function'])
+    inputs = {argument: load_output(workdir, reference) for argument, reference in stage['inputs'].items()}
+    result = function(**inputs, **stage['params'])
+    _store_output(workdir, name, result)
+    return time.perf_counter() - t0
+
+
+def _init_worker(dask_threads, python_path):
+    """
+    Initializes a worker process: limits its dask threads, so that the workers together use all
+    cores once, and makes the modules importable that the parent process can import.
+    """
+    import dask
+    dask.config.set(scheduler='threads', num_workers=dask_threads)
+    sys.path.extend(path for path in python_path if path not in sys.path)
+
+
+def _load_state(workdir):
+    path = os.path.join(workdir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(workdir, state):
+    path = os.path.join(workdir, STATE_FILE)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def run_pipeline(spec, workers=None, executor=None, force=(), dry_run=False):
+    """
+    Runs all stages of a pipeline specification in dependency order.
+    Independent stages run concurrently; up-to-date stages are skipped.
+
+    Parameters:
+    - spec: Specification dictionary (see load_spec).
+    - workers: Number of concurrent stages (default: number of CPUs).
+    - executor: 'process' or 'thread' (default from the specification).
+    - force: Names of stages to rerun even if they are up to date (their dependents rerun as well).
+    - dry_run: Only report which stages would run.
+
+    Returns:
+    - Dictionary mapping each stage name to 'skipped', 'done', 'failed' or 'blocked'.
+      For a dry run, stages that would run are reported as 'pending'.
+    """
+    stages = spec['stages']
+    workdir = spec['workdir']
+    os.makedirs(workdir, exist_ok=True)
+    workers = workers or spec['workers'] or os.cpu_count()
+    executor = executor or spec['executor']
+
+    keys = stage_keys(stages)
+    state = _load_state(workdir)
+    status = {}
+    for name in _topological_order(stages):
+        up_to_date = (state.get(name) == keys[name] and name not in force
+                      and _has_output(workdir, name)
+                      and all(status[dep] == 'skipped' for dep in _dependencies(stages[name])))
+        status[name] = 'skipped' if up_to_date else 'pending'
+        logger.info('%-20s %s', name, 'up to date' if up_to_date else 'scheduled')
+    if dry_run:
+        return status
+
+    import dask
+
+    dask_threads = max(1, (os.cpu_count() or 1) // workers)
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dask_threads, list(sys.path)))
+        dask_config = contextlib.nullcontext()
+    else:
+        # Threads share the dask configuration of this process, so it is only changed while the pipeline runs
+        pool = ThreadPoolExecutor(max_workers=workers)
+        dask_config = dask.config.set(scheduler='threads', num_workers=dask_threads)
+    with dask_config, pool:
+        running = {}
+        while True:
+            # Submit every pending stage whose dependencies are finished
+            for name, stage in stages.items():
+                if status[name] != 'pending':
+                    continue
+                dependency_status = {status[dep] for dep in _dependencies(stage)}
+                if dependency_status & {'failed', 'blocked'}:
+                    status[name] = 'blocked'
+                    logger.error('%-20s blocked by a failed dependency', name)
+                elif dependency_status <= {'skipped', 'done'}:
+                    status[name] = 'running'
+                    running[pool.submit(run_stage, workdir, name, stage)] = name
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as err:
+                    status[name] = 'failed'
+                    logger.error('%-20s failed: %r', name, err)
+                    continue
+                status[name] = 'done'
+                # Record success immediately, so that a later failure resumes after this stage
+                state[name] = keys[name]
+                _save_state(workdir, state)
+                logger.info('%-20s done in %.1fs', name, seconds)
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a batch analysis pipeline from a TOML or YAML specification.')
+    parser.add_argument('spec', help='Pipeline specification (.toml, .yaml or .yml).')
+    parser.add_argument('--workers', type=int, default=None, help='Number of concurrent stages (default: all cores).')
+    parser.add_argument('--executor', choices=['process', 'thread'], default=None, help='Type of worker pool.')
+    parser.add_argument('--force', nargs='*', default=[], help='Stages to rerun even if they are up to date.')
+    parser.add_argument('--dry-run', action='store_true', help='Only show which stages would run.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if SESSION2_DIR not in sys.path:
+        sys.path.append(SESSION2_DIR)
+    spec = load_spec(args.spec)
+    status = run_pipeline(spec, workers=args.workers, executor=args.executor, force=args.force, dry_run=args.dry_run)
+    return 1 if any(s in ('failed', 'blocked') for s in status.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,418 @@
+import os
+import json
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:  # psutil is optional, /proc is used as a fallback on Linux
+    psutil = None
+
+
+logger = logging.getLogger(__name__)
+
+# Profiler used by all instrumented functions when no profiler is passed explicitly
+_active_profiler = None
+
+
+def _proc_status_mb(field):
+    """Reads a memory field (e.g. 'VmHWM', 'VmRSS') from /proc/self/status in MB, or None."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _current_rss_mb():
+    """Returns the current resident set size of the process in MB, or None if unavailable."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024**2
+    return _proc_status_mb('VmRSS')
+
+
+class _PeakMemoryTracker:
+    """
+    Tracks the peak resident memory of the process while stages are open. Memory is shared by
+    all threads, so every open stage (also of other profilers and threads) is charged with the
+    peak reached while it was open.
+
+    The resident memory is sampled in a background thread while stages are open. On Linux the
+    kernel high-water mark (VmHWM) is also compared at the start and end of every stage: if it
+    rose, the new maximum was reached during the stage, which catches peaks shorter than the
+    sampling interval. The high-water mark is never reset, so tools like /usr/bin/time and
+    batch schedulers still see the peak of the whole process.
+    """
+    interval = 0.05  # sampling interval in seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._open = {}  # open event -> high-water mark when it started
+        self._sampler = None
+
+    def _checkpoint(self, peak):
+        """Charges peak to all open stages (caller holds the lock)."""
+        if peak is None:
+            return
+        for event in self._open:
+            if event.peak_rss_mb is None or peak > event.peak_rss_mb:
+                event.peak_rss_mb = peak
+
+    def _sample(self):
+        """Background loop that samples the resident memory while stages are open."""
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+                self._checkpoint(_current_rss_mb())
+
+    def begin(self, event):
+        with self._lock:
+            self._open[event] = _proc_status_mb('VmHWM')
+            self._checkpoint(_current_rss_mb())
+            if self._sampler is None and event.peak_rss_mb is not None:
+                self._sampler = threading.Thread(target=self._sample, name='profiling-rss', daemon=True)
+                self._sampler.start()
+
+    def end(self, event):
+        with self._lock:
+            self._checkpoint(_current_rss_mb())
+            hwm_start = self._open.pop(event)
+            hwm_end = _proc_status_mb('VmHWM')
+            if hwm_start is not None and hwm_end is not None and hwm_end > hwm_start:
+                event.peak_rss_mb = max(event.peak_rss_mb or 0.0, hwm_end)
+
+
+# Created on the first profiled stage, so importing the module starts no thread
+_memory_tracker = None
+_memory_tracker_lock = threading.Lock()
+
+
+def _get_memory_tracker():
+    """Returns the process-wide memory tracker, creating it on first use."""
+    global _memory_tracker
+    with _memory_tracker_lock:
+        if _memory_tracker is None:
+            _memory_tracker = _PeakMemoryTracker()
+        return _memory_tracker
+
+
+def _bytes_read():
+    """
+    Returns the number of bytes the current process has read from storage so far,
+    or None if I/O counters are not available on this platform.
+    """
+    if psutil is not None:
+        try:
+            return psutil.Process().io_counters().read_bytes
+        except (AttributeError, psutil.Error):
+            pass
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('read_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def count_dask_tasks(obj):
+    """
+    Counts the tasks in the dask graph behind an xarray/dask object.
+
+    Parameters:
+    - obj: xarray.Dataset, xarray.DataArray, dask collection or a tuple of those.
+
+    Returns:
+    - Number of tasks (int), 0 for objects that are not backed by dask.
+    """
+    if isinstance(obj, (tuple, list)):
+        return sum(count_dask_tasks(item) for item in obj)
+    graph = obj.__dask_graph__() if hasattr(obj, '__dask_graph__') else None
+    return len(graph) if graph is not None else 0
+
+
+def _dask_callback(event):
+    """
+    Returns a dask callback that charges the time and tasks of dask computations started by the
+    thread of the event to the event, or None if dask is not installed. Only the local schedulers
+    (threads, processes, synchronous) report to callbacks; dask.distributed does not.
+    """
+    try:
+        from dask.callbacks import Callback
+    except ImportError:
+        return None
+
+    starts = []
+
+    def start(dsk):
+        if threading.get_ident() == event.thread_id:
+            starts.append(time.perf_counter())
+            event.dask_tasks_executed += len(dsk)
+
+    def finish(dsk, state, errored):
+        if threading.get_ident() == event.thread_id and starts:
+            event.dask_compute_time += time.perf_counter() - starts.pop()
+
+    return Callback(start=start, finish=finish)
+
+
+class StageEvent:
+    """
+    A single profiled stage. Created by StageProfiler.stage() and filled in when the stage ends.
+
+    Attributes:
+    -----------
+    stage : str
+        Name of the stage (e.g. 'climatology', 'detrend', 'wavelet').
+    variable : str or None
+        Variable the stage was run for, if the stage works per variable.
+    start : float
+        Start time (seconds since the epoch).
+    wall_time : float
+        Duration of the stage in seconds.
+    peak_rss_mb : float or None
+        Peak resident memory of the process while the stage was running in MB.
+    dask_compute_time : float
+        Seconds spent in dask computations started by this thread during the stage.
+    dask_tasks_executed : int
+        Number of dask tasks executed by those computations.
+    bytes_read : int or None
+        Bytes read from storage during the stage.
+    dask_tasks : int
+        Number of dask tasks in the objects registered with track().
+    """
+    def __init__(self, stage, variable=None):
+        self.stage = stage
+        self.variable = variable
+        self.start = None
+        self.wall_time = None
+        self.peak_rss_mb = None
+        self.bytes_read = None
+        self.dask_tasks = 0
+        self.dask_compute_time = 0.0
+        self.dask_tasks_executed = 0
+        self.thread_id = threading.get_ident()
+        self.error = None
+
+    def track(self, obj):
+        """
+        Registers the result of the stage so its dask task count is recorded.
+        Returns obj unchanged, so it can be used inline.
+        """
+        self.dask_tasks += count_dask_tasks(obj)
+        return obj
+
+    def to_dict(self):
+        """Returns the event as a JSON-serialisable dictionary."""
+        return {
+            'stage': self.stage,
+            'variable': self.variable,
+            'start': self.start,
+            'wall_time': self.wall_time,
+            'peak_rss_mb': self.peak_rss_mb,
+            'bytes_read': self.bytes_read,
+            'dask_tasks': self.dask_tasks,
+            'dask_compute_time': self.dask_compute_time,
+            'dask_tasks_executed': self.dask_tasks_executed,
+            'error': self.error,
+        }
+
+
+class _NullEvent:
+    """Stand-in for StageEvent when profiling is disabled."""
+    def track(self, obj):
+        return obj
+
+
+class StageProfiler:
+    """
+    Records wall time, peak memory, bytes read and dask task counts for the stages
+    of an analysis and reports them as structured events.
+
+    Note: xarray operations on dask-backed data are lazy. For such data the wall time of a
+    stage covers building the task graph; the actual computation is charged to the stage
+    that triggers it (e.g. 'save', 'cache_write', plotting or .compute() inside a stage),
+    whose dask_compute_time shows how much of its wall time was spent computing.
+
+    Attributes:
+    -----------
+    events : list of StageEvent
+        All finished events, in the order in which they finished.
+
+    Methods:
+    --------
+    stage(name, variable=None):
+        Context manager that profiles the enclosed block.
+    activate():
+        Makes this profiler the default for all instrumented functions.
+    to_json(filepath):
+        Writes all events to a JSON file.
+    to_chrome_trace(filepath):
+        Writes all events in Chrome trace format (chrome://tracing, Perfetto).
+    summary():
+        Returns total wall time per stage.
+    """
+    def __init__(self, callback=None, log_level=logging.INFO):
+        """
+        Initializes the profiler.
+
+        Parameters:
+        - callback: Optional function called with the event dictionary after every stage.
+        - log_level: Logging level for the events sent to the 'profiling' logger.
+                     Use None to disable logging.
+        """
+        self.callback = callback
+        self.log_level = log_level
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, variable=None):
+        """
+        Profiles the enclosed block as one stage and yields the StageEvent.
+        Call event.track(result) inside the block to record the dask task count.
+        Dask computations run inside the block are recorded in dask_compute_time.
+        """
+        event = StageEvent(name, variable)
+        callback = _dask_callback(event)
+        memory_tracker = _get_memory_tracker()
+        read_before = _bytes_read()
+        memory_tracker.begin(event)
+        event.start = time.time()
+        t0 = time.perf_counter()
+        try:
+            if callback is not None:
+                callback.register()
+            yield event
+        except BaseException as err:
+            event.error = repr(err)
+            raise
+        finally:
+            event.wall_time = time.perf_counter() - t0
+            if callback is not None:
+                callback.unregister()
+            memory_tracker.end(event)
+            read_after = _bytes_read()
+            if read_before is not None and read_after is not None:
+                event.bytes_read = read_after - read_before
+            self._emit(event)
+
+    def _emit(self, event):
+        """Stores the event and forwards it to the logger and callback."""
+        with self._lock:
+            self.events.append(event)
+        record = event.to_dict()
+        if self.log_level is not None:
+            logger.log(self.log_level, 'stage=%s variable=%s wall_time=%.3fs dask_compute_time=%.3fs '
+                       'peak_rss=%sMB bytes_read=%s dask_tasks=%d',
+                       event.stage, event.variable, event.wall_time, event.dask_compute_time,
+                       event.peak_rss_mb, event.bytes_read, event.dask_tasks)
+        if self.callback is not None:
+            self.callback(record)
+
+    @contextmanager
+    def activate(self):
+        """
+        Makes this profiler the default profiler inside a with-block, so functions decorated
+        with @profile_stage (e.g. in ekman_dynamics and trend_analysis) report to it.
+        """
+        previous = set_profiler(self)
+        try:
+            yield self
+        finally:
+            set_profiler(previous)
+
+    def summary(self):
+        """
+        Returns a dictionary with the total wall time in seconds for each stage.
+        """
+        totals = {}
+        for event in self.events:
+            totals[event.stage] = totals.get(event.stage, 0.0) + event.wall_time
+        return totals
+
+    def to_json(self, filepath):
+        """
+        Writes all events to a JSON file as a list of dictionaries.
+        """
+        with open(filepath, 'w') as f:
+            json.dump([event.to_dict() for event in self.events], f, indent=2)
+
+    def to_chrome_trace(self, filepath):
+        """
+        Writes all events to a trace file in Chrome trace format, which can be opened
+        with chrome://tracing or https://ui.perfetto.dev.
+        """
+        pid = os.getpid()
+        trace_events = []
+        for event in self.events:
+            name = event.stage if event.variable is None else f'{event.stage} [{event.variable}]'
+            args = {k: v for k, v in event.to_dict().items() if k not in ('stage', 'start', 'wall_time')}
+            trace_events.append({
+                'name': name,
+                'cat': event.stage,
+                'ph': 'X',  # complete event with start and duration
+                'ts': event.start * 1e6,  # microseconds
+                'dur': event.wall_time * 1e6,
+                'pid': pid,
+                'tid': event.thread_id,
+                'args': args,
+            })
+        with open(filepath, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+def set_profiler(profiler):
+    """
+    Sets the default profiler used by instrumented functions and returns the previous one.
+    Pass None to disable profiling.
+    """
+    global _active_profiler
+    previous = _active_profiler
+    _active_profiler = profiler
+    return previous
+
+
+def get_profiler():
+    """Returns the default profiler, or None if profiling is disabled."""
+    return _active_profiler
+
+
+@contextmanager
+def stage(name, variable=None, profiler=None):
+    """
+    Profiles the enclosed block with the given profiler, or with the default profiler if
+    none is given. Does nothing (apart from yielding a dummy event) if profiling is disabled.
+    """
+    profiler = profiler if profiler is not None else _active_profiler
+    if profiler is None:
+        yield _NullEvent()
+        return
+    with profiler.stage(name, variable) as event:
+        yield event
+
+
+def profile_stage(name):
+    """
+    Decorator that profiles every call of a function as a stage with the given name,
+    using the default profiler. The return value is tracked for its dask task count.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active_profiler is None:
+                return func(*args, **kwargs)
+            with _active_profiler.stage(name) as event:
+                return event.track(func(*args, **kwargs))
+        return wrapper
+    return decorator
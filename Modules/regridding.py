@@ -0,0 +1,237 @@
+import os
+import hashlib
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+
+# Default location of the stored weight matrices; set OCEAN_REGRID_DIR to use another location
+DEFAULT_WEIGHTS_DIR = os.environ.get('OCEAN_REGRID_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ocean_regrid'))
+
+
+def _coord_names(obj):
+    """Detects the latitude and longitude coordinate names (e.g. 'lat' or 'latitude')."""
+    lat_name = next((c for c in obj.coords if 'lat' in c), None)
+    lon_name = next((c for c in obj.coords if 'lon' in c), None)
+    if lat_name is None or lon_name is None:
+        raise ValueError("Longitude or latitude coordinate not found in the dataset.")
+    return lat_name, lon_name
+
+
+def _cell_edges(centers):
+    """
+    Computes the cell edges of a 1D grid from the cell centers (midpoints between the centers,
+    half a cell beyond the first and last center). Works for ascending and descending grids.
+    """
+    centers = np.asarray(centers, dtype=float)
+    if centers.size == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    mid = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - mid[0]], mid, [2 * centers[-1] - mid[-1]]])
+
+
+def _overlaps(src_edges, dst_edges):
+    """
+    Returns the overlap length of every target cell with every source cell (n_dst x n_src).
+    Edges may be ascending or descending.
+    """
+    src_lo = np.minimum(src_edges[:-1], src_edges[1:])
+    src_hi = np.maximum(src_edges[:-1], src_edges[1:])
+    dst_lo = np.minimum(dst_edges[:-1], dst_edges[1:])
+    dst_hi = np.maximum(dst_edges[:-1], dst_edges[1:])
+    return np.clip(np.minimum(dst_hi[:, None], src_hi[None, :]) - np.maximum(dst_lo[:, None], src_lo[None, :]), 0, None)
+
+
+def _conservative_1d(src, dst, axis):
+    """
+    First-order conservative weights along one axis. Latitude overlaps are measured in sin(lat),
+    which is proportional to the area of a latitude band; longitudes are periodic.
+    Row i holds the fraction of target cell i covered by each source cell.
+    """
+    src_edges, dst_edges = _cell_edges(src), _cell_edges(dst)
+    if axis == 'lat':
+        src_edges = np.sin(np.deg2rad(np.clip(src_edges, -90, 90)))
+        dst_edges = np.sin(np.deg2rad(np.clip(dst_edges, -90, 90)))
+        overlap = _overlaps(src_edges, dst_edges)
+    else:
+        # Longitudes of source and target may use different conventions (0..360 / -180..180)
+        overlap = sum(_overlaps(src_edges + shift, dst_edges) for shift in (-360, 0, 360))
+    width = np.abs(np.diff(dst_edges))
+    return sparse.csr_matrix(overlap / width[:, None])
+
+
+def _bilinear_1d(src, dst, axis):
+    """
+    Linear interpolation weights along one axis (rows: target points, columns: source points).
+    Longitudes are treated as periodic for global grids. Targets outside the source range get no weights.
+    """
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    order = np.argsort(src)
+    src_sorted = src[order]
+    periodic = axis == 'lon' and src_sorted[-1] - src_sorted[0] + np.abs(np.diff(src_sorted)).mean() >= 359.9
+    if periodic:
+        # Map targets into the source range and append the first point after the last one
+        dst = (dst - src_sorted[0]) % 360 + src_sorted[0]
+        src_sorted = np.append(src_sorted, src_sorted[0] + 360)
+        order = np.append(order, order[0])
+
+    upper = np.clip(np.searchsorted(src_sorted, dst, side='right'), 1, src_sorted.size - 1)
+    lower = upper - 1
+    span = src_sorted[upper] - src_sorted[lower]
+    frac = (dst - src_sorted[lower]) / span
+    inside = (dst >= src_sorted[0]) & (dst <= src_sorted[-1])
+
+    rows = np.repeat(np.arange(dst.size)[inside], 2)
+    cols = np.column_stack([order[lower], order[upper]])[inside].ravel()
+    vals = np.column_stack([1 - frac, frac])[inside].ravel()
+    return sparse.csr_matrix((vals, (rows, cols)), shape=(dst.size, src.size))
+
+
+def compute_weights(src_lat, src_lon, dst_lat, dst_lon, method='conservative'):
+    """
+    Computes the sparse weight matrix that maps a field on the source grid (flattened lat x lon,
+    row-major) onto the target grid. For regular lat/lon grids the 2D weights are the Kronecker
+    product of the weights along latitude and longitude.
+
+    Parameters:
+    - src_lat, src_lon: 1D cell-center coordinates of the source grid.
+    - dst_lat, dst_lon: 1D cell-center coordinates of the target grid.
+    - method: 'conservative' (first-order, area weighted) or 'bilinear'.
+
+    Returns:
+    - scipy.sparse.csr_matrix of shape (n_dst_lat * n_dst_lon, n_src_lat * n_src_lon).
+    """
+    if method == 'conservative':
+        weights_1d = _conservative_1d
+    elif method == 'bilinear':
+        weights_1d = _bilinear_1d
+    else:
+        raise ValueError("method must be 'conservative' or 'bilinear'.")
+    w_lat = weights_1d(src_lat, dst_lat, 'lat')
+    w_lon = weights_1d(src_lon, dst_lon, 'lon')
+    weights = sparse.kron(w_lat, w_lon, format='csr')
+    weights.eliminate_zeros()
+    return weights
+
+
+def _apply_weights(values, weights, shape_out, min_coverage):
+    """
+    Applies the weights to the last two axes of values as one sparse matrix product.
+    Missing values are excluded and the weights renormalized; target cells whose valid
+    source coverage is below min_coverage become NaN.
+    """
+    batch_shape = values.shape[:-2]
+    flat = values.reshape(-1, values.shape[-2] * values.shape[-1]).T  # (n_src, n_batch)
+    valid = ~np.isnan(flat)
+    summed = weights @ np.where(valid, flat, 0)
+    coverage = weights @ valid.astype(flat.dtype)
+    total = np.asarray(weights.sum(axis=1))  # (n_dst, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = summed / coverage
+        result[(coverage <= min_coverage * total) | (coverage == 0)] = np.nan
+    # The weights are float64; keep single precision input in single precision
+    result = result.astype(np.result_type(values.dtype, np.float32), copy=False)
+    return result.T.reshape(*batch_shape, *shape_out)
+
+
+class Regridder:
+    """
+    Regrids fields between regular lat/lon grids, e.g. 0.25° OISST/ERA5 onto the 1° EN4 grid.
+
+    The weights are computed once per source/target grid pair and method and stored as a sparse
+    matrix (scipy .npz) on disk, so harmonizing further variables or years only costs a sparse
+    matrix product per time step. For dask-backed data the product is applied chunk by chunk
+    along time.
+
+    Attributes:
+    -----------
+    method : str
+        'conservative' or 'bilinear'.
+    weights : scipy.sparse.csr_matrix
+        Weight matrix (target cells x source cells).
+    min_coverage : float
+        Minimum fraction of a target cell that must be covered by valid source data.
+
+    Methods:
+    --------
+    regrid(data):
+        Regrids an xarray.DataArray or xarray.Dataset onto the target grid (also available as regridder(data)).
+    """
+    def __init__(self, source, target, method='conservative', weights_dir=None, min_coverage=0.0):
+        """
+        Initializes the regridder and loads the weights from disk or computes and stores them.
+
+        Parameters:
+        - source: xarray.Dataset or DataArray on the source grid (only its lat/lon coordinates are used).
+        - target: xarray.Dataset or DataArray on the target grid.
+        - method: 'conservative' or 'bilinear'.
+        - weights_dir: Directory for stored weights (default OCEAN_REGRID_DIR or ~/.cache/ocean_regrid).
+        - min_coverage: Target cells with a smaller valid fraction (e.g. at coastlines) become NaN.
+        """
+        self.method = method
+        self.min_coverage = min_coverage
+        self._src_lat_name, self._src_lon_name = _coord_names(source)
+        dst_lat_name, dst_lon_name = _coord_names(target)
+        self._src_lat = np.asarray(source[self._src_lat_name].values, dtype=float)
+        self._src_lon = np.asarray(source[self._src_lon_name].values, dtype=float)
+        self._dst_lat = np.asarray(target[dst_lat_name].values, dtype=float)
+        self._dst_lon = np.asarray(target[dst_lon_name].values, dtype=float)
+
+        weights_dir = weights_dir if weights_dir is not None else DEFAULT_WEIGHTS_DIR
+        self.weights_file = os.path.join(weights_dir, f"{method}_{self._grid_hash()}.npz")
+        if os.path.exists(self.weights_file):
+            self.weights = sparse.load_npz(self.weights_file).tocsr()
+        else:
+            self.weights = compute_weights(self._src_lat, self._src_lon, self._dst_lat, self._dst_lon, method)
+            os.makedirs(weights_dir, exist_ok=True)
+            tmp_file = f"{self.weights_file}.{os.getpid()}.tmp.npz"
+            sparse.save_npz(tmp_file, self.weights)
+            os.replace(tmp_file, self.weights_file)
+
+    def _grid_hash(self):
+        """Identifies the source/target grid pair by the values of their coordinates."""
+        h = hashlib.sha1()
+        for coords in (self._src_lat, self._src_lon, self._dst_lat, self._dst_lon):
+            h.update(np.ascontiguousarray(coords).tobytes())
+            h.update(b'|')
+        return h.hexdigest()[:20]
+
+    def regrid(self, data):
+        """
+        Regrids a DataArray or all variables of a Dataset with lat/lon dimensions onto the target grid.
+        The coordinate names of the source are kept. Variables without lat/lon are returned unchanged.
+        """
+        if isinstance(data, xr.Dataset):
+            return data.map(lambda var: self.regrid(var) if {self._src_lat_name, self._src_lon_name} <= set(var.dims) else var)
+
+        lat, lon = self._src_lat_name, self._src_lon_name
+        shape_out = (self._dst_lat.size, self._dst_lon.size)
+        result = xr.apply_ufunc(
+            _apply_weights, data,
+            kwargs={'weights': self.weights, 'shape_out': shape_out, 'min_coverage': self.min_coverage},
+            input_core_dims=[[lat, lon]], output_core_dims=[[lat, lon]],
+            exclude_dims={lat, lon},  # lat and lon change size
+            dask='parallelized', output_dtypes=[np.result_type(data.dtype, np.float32)],
+            dask_gufunc_kwargs={'output_sizes': {lat: shape_out[0], lon: shape_out[1]}, 'allow_rechunk': True},
+            keep_attrs=True,
+        )
+        # Rows of the weights are ordered like the target grid
+        return result.assign_coords({lat: self._dst_lat, lon: self._dst_lon})
+
+    __call__ = regrid
+
+
+def regrid(data, target, method='conservative', weights_dir=None, min_coverage=0.0):
+    """
+    Regrids data onto the grid of target, using stored weights if available.
+
+    Parameters:
+    - data: xarray.DataArray or Dataset on the source grid.
+    - target: xarray object on the target grid.
+    - method: 'conservative' or 'bilinear'.
+    - weights_dir: Directory for stored weights.
+    - min_coverage: Minimum valid fraction of a target cell (see Regridder).
+    """
+    return Regridder(data, target, method, weights_dir, min_coverage).regrid(data)
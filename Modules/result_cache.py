@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import uuid
+
+import xarray as xr
+
+from profiling import stage
+
+
+# Per user by default. To share results with other users on the same machine, set OCEAN_CACHE_DIR
+# (or pass cache_dir) to a directory all of them can write to, e.g. /srv/ocean_results
+DEFAULT_CACHE_DIR = os.environ.get('OCEAN_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ocean_results'))
+
+# Default size limit of the cache: 20 GB
+DEFAULT_MAX_BYTES = 20 * 1024**3
+
+# Entries used within this many seconds are not evicted, because another process may still be
+# reading them lazily (results returned by get() are opened with xr.open_zarr)
+DEFAULT_GRACE_PERIOD = 3600
+
+# Increase when the stored layout changes, so that old entries are no longer used
+CACHE_VERSION = 2
+
+_ACCESS_FILE = '.last_access'
+_META_FILE = '.cache_meta.json'
+
+
+def _source_files(ds):
+    """
+    Collects the files a dataset was opened from (xr.open_dataset / xr.open_mfdataset).
+    """
+    sources = set()
+    for obj in [ds, *ds.variables.values()]:
+        source = obj.encoding.get('source')
+        if isinstance(source, str) and os.path.exists(source):
+            sources.add(os.path.abspath(source))
+    return sorted(sources)
+
+
+def _lazy_index_keys(data):
+    """
+    Returns the indexers xarray applied to a variable that has not been loaded from its file yet
+    (e.g. from .isel or .sel), by unwrapping its lazily indexed arrays.
+    """
+    keys = []
+    while hasattr(data, 'array'):
+        key = getattr(data, 'key', None)
+        if key is not None:
+            keys.append(key.tuple)
+        data = data.array
+    return keys
+
+
+def fingerprint(obj):
+    """
+    Computes a fingerprint of an xarray object that changes whenever its input data changes.
+
+    The fingerprint combines the paths, modification times and sizes of the source files with a
+    token of every variable. No data is read for variables that still live in the source files:
+    for dask-backed data (opened with chunks=...) the tokens are derived from the file name and
+    mtime, and for variables opened without chunks and not loaded yet from their name, shape,
+    dtype and the selection applied to them. For data held in memory the tokens are checksums
+    of the values.
+
+    Parameters:
+    - obj: xarray.Dataset, xarray.DataArray, or a tuple/list of those.
+
+    Returns:
+    - Hex string of the fingerprint.
+    """
+    # dask is only needed once a cache is used, which keeps importing the analysis modules fast
+    from dask.base import tokenize
+
+    if isinstance(obj, (tuple, list)):
+        return tokenize([fingerprint(item) for item in obj])
+    if isinstance(obj, xr.DataArray):
+        obj = obj.to_dataset(name=obj.name if obj.name is not None else '_cached_values')
+    if not isinstance(obj, xr.Dataset):
+        # Plain parameters (numbers, strings, numpy arrays) are tokenized directly
+        return tokenize(obj)
+
+    files = [(path, os.path.getmtime(path), os.path.getsize(path)) for path in _source_files(obj)]
+
+    def variable_token(var):
+        if files and var.chunks is None and not var._in_memory:
+            # Not loaded yet: the source files identify the values, so they are not read
+            return tokenize(var.dims, var.shape, str(var.dtype), var.attrs, _lazy_index_keys(var._data))
+        return tokenize(var)
+
+    # Sort everything explicitly, dask does not tokenize sets (e.g. coord names) deterministically
+    variables = [(name, variable_token(obj.variables[name])) for name in sorted(obj.variables, key=str)]
+    coord_names = sorted(obj.coords, key=str)
+    return tokenize(files, variables, coord_names, json.dumps(obj.attrs, sort_keys=True, default=str))
+
+
+def _directory_size(path):
+    """Returns the total size of all files below path in bytes."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def result_to_dataset(result):
+    """
+    Converts a result (Dataset, DataArray or tuple of DataArrays) into a Dataset for storage.
+    Returns the dataset and a description of how to restore the original type.
+    """
+    if isinstance(result, xr.Dataset):
+        return result, {'kind': 'dataset'}
+    if isinstance(result, xr.DataArray):
+        return result.to_dataset(name='_cached_values'), {'kind': 'dataarray', 'name': result.name}
+    if isinstance(result, tuple) and all(isinstance(item, xr.DataArray) for item in result):
+        ds = xr.merge([item.to_dataset(name=f'__item{i}__') for i, item in enumerate(result)],
+                      combine_attrs='drop')
+        return ds, {'kind': 'tuple', 'names': [item.name for item in result]}
+    raise TypeError("Only xarray.Dataset, xarray.DataArray or tuples of DataArrays can be cached.")
+
+
+def dataset_to_result(ds, meta):
+    """Restores the original result type from a stored dataset (inverse of result_to_dataset)."""
+    if meta['kind'] == 'dataarray':
+        return ds['_cached_values'].rename(meta['name'])
+    if meta['kind'] == 'tuple':
+        return tuple(ds[f'__item{i}__'].rename(name) for i, name in enumerate(meta['names']))
+    return ds
+
+
+def prepare_for_zarr(ds):
+    """
+    Removes encodings inherited from the source files and gives dask arrays regular chunks,
+    both of which Zarr requires. Operations like groupby can leave very small chunks (e.g. one
+    time step each), so dask arrays are rechunked to dask's automatic chunk size.
+    """
+    ds = ds.copy()
+    for var in ds.variables.values():
+        var.encoding = {}
+    if any(var.chunks is not None for var in ds.variables.values()):
+        ds = ds.chunk('auto')
+    return ds
+
+
+class ResultCache:
+    """
+    A content-addressed on-disk cache for derived products (climatology, anomalies, trends,
+    Ekman products, ...). Entries are stored as Zarr stores, keyed by a fingerprint of the
+    input data plus the method name and its parameters. The total size of the cache is
+    bounded; least recently used entries are removed first.
+
+    Attributes:
+    -----------
+    cache_dir : str
+        Directory holding the cache entries. Defaults to $OCEAN_CACHE_DIR if it is set, otherwise
+        ~/.cache/ocean_results. Several users on the same machine share results when they use the
+        same directory, which must be writable by all of them.
+    max_bytes : int
+        Maximum total size of the cache in bytes.
+    grace_period : float
+        Entries used within this many seconds are never evicted, so the cache can temporarily
+        exceed max_bytes while many entries are in use.
+
+    Methods:
+    --------
+    key(inputs, method, params=None):
+        Returns the cache key for the given inputs, method and parameters.
+    get(key):
+        Returns the cached result or None.
+    put(key, result):
+        Stores a result and returns it, reopened lazily from the cache.
+    get_or_compute(inputs, method, params, compute):
+        Returns the cached result or computes, stores and returns it.
+    evict():
+        Removes least recently used entries (outside the grace period) until the cache fits into max_bytes.
+    clear():
+        Removes all entries.
+    """
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES, grace_period=DEFAULT_GRACE_PERIOD):
+        self.cache_dir = cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        self.grace_period = grace_period
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, inputs, method, params=None):
+        """
+        Computes the cache key from the input data, the method name and its parameters.
+
+        Parameters:
+        - inputs: xarray object (or tuple of xarray objects) the result is derived from.
+        - method: Name of the method that produces the result (e.g. 'TimeSeriesAnalyzer.compute_climatology').
+        - params: Dictionary of parameters of the method.
+        """
+        from dask.base import tokenize
+
+        params_token = json.dumps(params or {}, sort_keys=True, default=str)
+        token = tokenize(CACHE_VERSION, fingerprint(inputs), method, params_token)
+        # Prefix with a readable method name, which makes the cache directory easier to inspect
+        prefix = method.replace('.', '_').replace(os.sep, '_')
+        return f"{prefix}-{hashlib.sha1(token.encode()).hexdigest()[:24]}"
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.zarr")
+
+    def get(self, key):
+        """
+        Returns the result stored under key (lazily loaded from Zarr), or None if it is not cached.
+        """
+        path = self._path(key)
+        meta_file = os.path.join(path, _META_FILE)
+        if not os.path.exists(meta_file):
+            return None
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            ds = xr.open_zarr(path)
+        except (OSError, ValueError, KeyError):
+            # Entry is incomplete or was removed by another process in the meantime
+            return None
+        self._touch(path)
+        return dataset_to_result(ds, meta)
+
+    def put(self, key, result, profiler=None):
+        """
+        Stores a result under key and returns it, reopened lazily from the cache.
+        The entry is written to a temporary location first and then moved into place,
+        so concurrent readers never see a partially written entry.
+        Writing triggers the computation of lazy (dask) results, so it is profiled as the
+        stage 'cache_write' with the given or the default profiler.
+        """
+        ds, meta = result_to_dataset(result)
+        path = self._path(key)
+        tmp_path = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4().hex}.zarr")
+        try:
+            with stage('cache_write', key, profiler=profiler):
+                prepare_for_zarr(ds).to_zarr(tmp_path, mode='w', consolidated=True)
+            with open(os.path.join(tmp_path, _META_FILE), 'w') as f:
+                json.dump(meta, f)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another process stored the same entry first; keep theirs
+                pass
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self._touch(path)
+        self.evict()
+        cached = self.get(key)
+        return cached if cached is not None else result
+
+    def get_or_compute(self, inputs, method, params, compute, profiler=None):
+        """
+        Returns the cached result for (inputs, method, params), or calls compute() and caches its result.
+
+        Parameters:
+        - inputs: xarray object(s) the result is derived from (used for the fingerprint).
+        - method: Name of the method that produces the result.
+        - params: Dictionary of parameters of the method.
+        - compute: Function without arguments that computes the result.
+        - profiler: Optional profiling.StageProfiler for the cache write (default profiler if None).
+        """
+        key = self.key(inputs, method, params)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        return self.put(key, compute(), profiler=profiler)
+
+    def _touch(self, path):
+        """Records the access time of an entry for the LRU eviction."""
+        try:
+            with open(os.path.join(path, _ACCESS_FILE), 'w') as f:
+                f.write(str(time.time()))
+        except OSError:
+            pass
+
+    def _entries(self):
+        """Returns a list of (last_access, size, path) for all complete entries."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not name.endswith('.zarr'):
+                continue
+            access_file = os.path.join(path, _ACCESS_FILE)
+            last_access = os.path.getmtime(access_file) if os.path.exists(access_file) else 0
+            entries.append((last_access, _directory_size(path), path))
+        return entries
+
+    def size(self):
+        """Returns the total size of the cache in bytes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is smaller than max_bytes.
+        Entries used within the grace period are kept, since they may still be read lazily.
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        recent = time.time() - self.grace_period
+        for last_access, size, path in entries:
+            # Entries are sorted by last access, so all remaining ones are recent as well
+            if total <= self.max_bytes or last_access > recent:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        for _, _, path in self._entries():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def cached_call(cache, method, inputs, params, compute, profiler=None):
+    """
+    Calls compute() directly if cache is None, otherwise returns the cached result.
+    Used by functions that take an optional cache argument.
+    """
+    if cache is None:
+        return compute()
+    return cache.get_or_compute(inputs, method, params, compute, profiler=profiler)
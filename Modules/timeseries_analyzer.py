@@ -1,10 +1,8 @@
 import xarray as xr
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.signal import detrend
-from scipy.stats import  chi2
-import pycwt as wavelet
 from numpy.fft import fft
+from profiling import stage
+from result_cache import cached_call
 
 class TimeSeriesAnalyzer:
     """
@@ -14,6 +12,9 @@ class TimeSeriesAnalyzer:
     Note: This class currently supports only time series with monthly or daily resolution. 
     For data with other temporal resolutions, the class needs to be extended and adjusted accordingly.
 
+    scipy, matplotlib and pycwt are imported on first use, so the module can be imported
+    in batch and dask workers without loading the plotting or wavelet libraries.
+
     Attributes:
     -----------
     _dataset : xarray.Dataset
@@ -24,6 +25,13 @@ class TimeSeriesAnalyzer:
         The dataset storing the climatology (mean for each time period).
     _annual_amplitude : xarray.Dataset
         The dataset storing the annual amplitude for each variable.
+    _profiler : profiling.StageProfiler or None
+        Optional profiler that records wall time, memory, bytes read and dask tasks
+        for each stage (climatology, anomaly, detrend, filtering, fft, wavelet, marine_heatwaves, save)
+        and for cache writes.
+    _cache : result_cache.ResultCache or None
+        Optional on-disk cache. Climatology, detrended anomalies and annual amplitude are
+        loaded from it if they were computed before for the same input data.
 
     Methods:
     --------
@@ -36,10 +44,13 @@ class TimeSeriesAnalyzer:
     compute_annual_amplitude():
         Calculates the annual amplitude for all variables in the dataset 
         based on the climatology.
+    detect_marine_heatwaves(variable, percentile=90, min_duration=5, max_gap=2, method='exact', climatology_period=None):
+        Detects marine heatwaves in daily SST and returns maps of event statistics and an event table.
     plot_std_and_annual_var(variable, vmin=0, vmax=10, cmap='plasma', background='white'):
         Plots the standard deviation of the original data and the annual variability.
-    save_results(filepath):
-        Saves the detrended anomaly dataset to a NetCDF file.
+    save_results(filepath, products=('anomalies',), **kwargs):
+        Saves derived products (anomalies, climatology, annual amplitude) to a compressed,
+        chunked NetCDF4 or Zarr file and reports the compression ratio and write throughput.
     filter_and_analyze_cycle(variable, vmin=0, vmax=2, window_size=15, cmap='plasma', background='white'):
         Applies a low-pass and high-pass filter to the data and visualizes the variability.
     compute_fft(variable, lon_min, lon_max, lat_min, lat_max, use_detrended=True, time_start=None, time_end=None):
@@ -49,15 +60,19 @@ class TimeSeriesAnalyzer:
         Performs a wavelet analysis using the Morlet wavelet on the selected variable 
         over the specified region, displaying the wavelet power spectrum and global power spectrum.
     """
-    def __init__(self, dataset):
+    def __init__(self, dataset, profiler=None, cache=None):
         """
         Initializes the TimeSeriesAnalyzer with the dataset.
         Stores the detrended anomalies and climatology in separate xarray.Datasets.
+        If no profiler is given, the default profiler from profiling.set_profiler() is used (if any).
+        If a result_cache.ResultCache is given, derived products are reused across sessions.
         """
         self._dataset = dataset
         self._ds_anom_detrended = xr.Dataset()
         self._climatology = xr.Dataset()
         self._annual_amplitude = xr.Dataset()
+        self._profiler = profiler
+        self._cache = cache
 
     @property
     def dataset(self):
@@ -81,6 +96,30 @@ class TimeSeriesAnalyzer:
         """Getter for the climatology dataset."""
         return self._climatology
 
+    @property
+    def profiler(self):
+        """Getter for the profiler."""
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, value):
+        """Setter for the profiler, None disables profiling for this instance."""
+        self._profiler = value
+
+    @property
+    def cache(self):
+        """Getter for the result cache."""
+        return self._cache
+
+    @cache.setter
+    def cache(self, value):
+        """Setter for the result cache, None disables caching for this instance."""
+        self._cache = value
+
+    def _stage(self, name, variable=None):
+        """Returns a context manager that profiles one stage of the analysis."""
+        return stage(name, variable, profiler=self._profiler)
+
     def _get_time_resolution(self):
         """
         Determines the time resolution of the dataset by examining the difference between time steps.
@@ -106,20 +145,28 @@ class TimeSeriesAnalyzer:
         Computes the climatology (mean for each month or day of the year) based on the time resolution.
         Automatically detects whether the data is daily or monthly.
         """
+        self._climatology = cached_call(self._cache, 'TimeSeriesAnalyzer.compute_climatology',
+                                        self._dataset, {}, self._compute_climatology,
+                                        profiler=self._profiler)
+        return self._climatology
+
+    def _compute_climatology(self):
+        """Computes the climatology without using the cache."""
         time_res = self._get_time_resolution()
 
         for var in self._dataset.data_vars:
-            if time_res == 1:
-                # Daily data: calculate climatology for each day of the year
-                climatology = self._dataset[var].groupby('time.dayofyear').mean('time')
-            elif time_res >= 28:
-                # Monthly data: calculate climatology for each month
-                climatology = self._dataset[var].groupby('time.month').mean('time')
-            else:
-                raise ValueError("Unsupported time resolution.")
-            
-            # Store the climatology for future use
-            self._climatology[var] = climatology
+            with self._stage('climatology', var) as event:
+                if time_res == 1:
+                    # Daily data: calculate climatology for each day of the year
+                    climatology = self._dataset[var].groupby('time.dayofyear').mean('time')
+                elif time_res >= 28:
+                    # Monthly data: calculate climatology for each month
+                    climatology = self._dataset[var].groupby('time.month').mean('time')
+                else:
+                    raise ValueError("Unsupported time resolution.")
+
+                # Store the climatology for future use
+                self._climatology[var] = event.track(climatology)
         return self._climatology
 
     def compute_anomalies_and_detrend(self):
@@ -127,6 +174,15 @@ class TimeSeriesAnalyzer:
         Computes the monthly climatology, anomalies, and detrends the anomalies.
         Handles both 3D and 4D datasets by automatically determining the dimensions.
         """
+        self._ds_anom_detrended = cached_call(self._cache, 'TimeSeriesAnalyzer.compute_anomalies_and_detrend',
+                                              self._dataset, {}, self._compute_anomalies_and_detrend,
+                                              profiler=self._profiler)
+        return self._ds_anom_detrended
+
+    def _compute_anomalies_and_detrend(self):
+        """Computes the detrended anomalies without using the cache."""
+        from scipy.signal import detrend
+
         # Ensure climatology is computed for all variables
         self.compute_climatology()
 
@@ -138,20 +194,22 @@ class TimeSeriesAnalyzer:
             # Retrieve precomputed climatology
             climatology = self._climatology[var]
 
-            if time_res == 1:
-                # Daily
-                anomalies = self._dataset[var].groupby('time.dayofyear') - climatology
-            elif time_res >= 28:
-                # Monthly
-                anomalies = self._dataset[var].groupby('time.month') - climatology
-
+            with self._stage('anomaly', var) as event:
+                if time_res == 1:
+                    # Daily
+                    anomalies = self._dataset[var].groupby('time.dayofyear') - climatology
+                elif time_res >= 28:
+                    # Monthly
+                    anomalies = self._dataset[var].groupby('time.month') - climatology
+                event.track(anomalies)
 
             # Detrend the anomalies along the time axis
-            detrended_anomalies = xr.apply_ufunc(
-                detrend, anomalies.fillna(0),
-                input_core_dims=[['time']], output_core_dims=[['time']],
-                dask='allowed'
-            ).where(~anomalies.isnull())  # Reapply the NaN mask
+            with self._stage('detrend', var) as event:
+                detrended_anomalies = event.track(xr.apply_ufunc(
+                    detrend, anomalies.fillna(0),
+                    input_core_dims=[['time']], output_core_dims=[['time']],
+                    dask='allowed'
+                ).where(~anomalies.isnull()))  # Reapply the NaN mask
 
             # Automatically transpose dimensions based on detected shape
             transpose_dims = ['time'] + [dim for dim in dims if dim not in ['time']]
@@ -172,7 +230,13 @@ class TimeSeriesAnalyzer:
         Computes the annual amplitude for all variables in the dataset based on the climatology.
         Stores the result in self._annual_amplitude as an xarray.Dataset.
         """
+        self._annual_amplitude = cached_call(self._cache, 'TimeSeriesAnalyzer.compute_annual_amplitude',
+                                             self._dataset, {}, self._compute_annual_amplitude,
+                                             profiler=self._profiler)
+        return self._annual_amplitude
 
+    def _compute_annual_amplitude(self):
+        """Computes the annual amplitude without using the cache."""
         # Ensure climatology is computed
         if not self._climatology:
             print("Climatology not found. Computing climatology first.")
@@ -195,8 +259,42 @@ class TimeSeriesAnalyzer:
             # Compute annual amplitude and store in xarray.Dataset
             self._annual_amplitude[var] = (max_clim - min_clim)/2
         return self._annual_amplitude
-    
+
+    def detect_marine_heatwaves(self, variable, percentile=90, min_duration=5, max_gap=2, method='exact',
+                                climatology_period=None):
+        """
+        Detects marine heatwaves (Hobday et al., 2016) in a daily SST variable at every grid cell,
+        relative to a day-of-year climatology and percentile threshold (see marine_heatwaves).
+
+        Parameters:
+        - variable: Name of the daily SST variable.
+        - percentile: Percentile of the threshold (default 90).
+        - min_duration: Minimum duration of an event in days (default 5).
+        - max_gap: Maximum gap in days between events that are joined (default 2).
+        - method: 'exact' windowed percentiles or 'approximate' (streaming moments, Cornish-Fisher).
+        - climatology_period: Optional (start, end) of the baseline period, e.g. ('1991', '2020').
+
+        Returns:
+        - maps: xarray.Dataset with event count, mean duration, total days and intensities per grid cell.
+        - events: pandas.DataFrame with one row per event.
+        """
+        from marine_heatwaves import detect_marine_heatwaves
+
+        if self._get_time_resolution() != 1:
+            raise ValueError("Marine heatwave detection requires daily data.")
+        data = self._dataset[variable]
+        if 'depth' in data.dims:
+            data = data.isel(depth=0)
+        with self._stage('marine_heatwaves', variable) as event:
+            event.track(data)
+            maps, events = detect_marine_heatwaves(data, percentile=percentile, min_duration=min_duration,
+                                                   max_gap=max_gap, method=method,
+                                                   climatology_period=climatology_period)
+        print(f"{variable}: {len(events)} marine heatwaves detected.")
+        return maps, events
+
     def plot_std_and_annual_var(self,variable, vmin=0, vmax=10, cmap='plasma', background='white'):
+        import matplotlib.pyplot as plt
 
         # Ensure climatology is computed for the specific variable
         if self._climatology is None or variable not in self._climatology:
@@ -223,36 +321,75 @@ class TimeSeriesAnalyzer:
 
     
 
-    def save_results(self, filepath):
+    def save_results(self, filepath, products=('anomalies',), **kwargs):
         """
-        Saves the detrended anomaly dataset to a NetCDF file.
+        Saves derived products to a NetCDF4 (.nc) or Zarr (.zarr) file using output_formats.write_product.
+        By default the data are stored as float32, zlib-compressed and chunked for time series access.
+        A single product is written to the root of the file, several products to one group each.
+
+        Parameters:
+        - filepath: Output file (.nc or .zarr).
+        - products: Products to save: 'anomalies', 'climatology' and/or 'annual_amplitude'.
+                    Products that have not been computed yet are computed first.
+        - kwargs: Output options passed to write_product, e.g. compression='zstd', keepbits=10 or pack_bits=16.
+
+        Returns:
+        - List with one report (sizes, compression ratio, write time and throughput) per product.
         """
-        self._ds_anom_detrended.to_netcdf(filepath, engine='h5netcdf', compute=True)
+        from output_formats import write_product
+
+        compute = {'anomalies': (lambda: self._ds_anom_detrended, self.compute_anomalies_and_detrend),
+                   'climatology': (lambda: self._climatology, self.compute_climatology),
+                   'annual_amplitude': (lambda: self._annual_amplitude, self.compute_annual_amplitude)}
+        if isinstance(products, str):
+            products = [products]
+
+        reports = []
+        for i, product in enumerate(products):
+            if product not in compute:
+                raise ValueError(f"Unknown product '{product}'. Choose from {list(compute)}.")
+            get_product, compute_product = compute[product]
+            if not get_product():
+                print(f"{product} not found. Computing {product} first.")
+                compute_product()
+
+            group = product if len(products) > 1 else None
+            # Writing computes lazy (dask) products, so this is where most of the time goes for dask data
+            with self._stage('save', product):
+                report = write_product(get_product(), filepath, group=group, mode='w' if i == 0 else 'a', **kwargs)
+            print(f"Saved {product}: {report['uncompressed_bytes'] / 1024**2:.1f} MB -> "
+                  f"{report['stored_bytes'] / 1024**2:.1f} MB (ratio {report['compression_ratio']:.1f}) "
+                  f"in {report['seconds']:.1f} s ({report['throughput_mb_s']:.1f} MB/s)")
+            reports.append(report)
+        return reports
 
     def filter_and_analyze_cycle(self, variable, vmin=0, vmax=2, window_size=15, cmap='plasma', background='white'):
         """
         Filters and analyzes the data by computing low-pass and high-pass components and visualizing them.
         Also retrieves or calculates the annual variability from the climatology.
         """
+        import matplotlib.pyplot as plt
+
         # Check if detrended anomalies for the specific variable have been calculated
         if self._ds_anom_detrended is None or variable not in self._ds_anom_detrended:
             # Compute anomalies and detrend them if they don't exist yet
             print(f"Detrended anomalies for {variable} not found. Computing anomalies and detrending the data.")
             self.compute_anomalies_and_detrend()
 
-        # Check if 'depth' exists in the dataset
-        if 'depth' in self._ds_anom_detrended[variable].dims:
-            # If 'depth' exists, select the surface layer
-            clean_data = self._ds_anom_detrended[variable].isel(depth=0).dropna(dim='time', how='all')
-        else:   
-            # If 'depth' does not exist, use the variable as is
-            clean_data = self._ds_anom_detrended[variable].dropna(dim='time', how='all')
-            
-        # Low-Pass Filter to remove high frequency variations
-        low_pass = clean_data.rolling(time=window_size, center=True).mean()
+        with self._stage('filtering', variable) as event:
+            # Check if 'depth' exists in the dataset
+            if 'depth' in self._ds_anom_detrended[variable].dims:
+                # If 'depth' exists, select the surface layer
+                clean_data = self._ds_anom_detrended[variable].isel(depth=0).dropna(dim='time', how='all')
+            else:
+                # If 'depth' does not exist, use the variable as is
+                clean_data = self._ds_anom_detrended[variable].dropna(dim='time', how='all')
+
+            # Low-Pass Filter to remove high frequency variations
+            low_pass = clean_data.rolling(time=window_size, center=True).mean()
 
-        # High-Pass Filter: difference of anomalies and low_pass to get higher frequency variations
-        high_pass = clean_data - low_pass
+            # High-Pass Filter: difference of anomalies and low_pass to get higher frequency variations
+            high_pass = event.track(clean_data - low_pass)
 
 
         # Plotting Setup
@@ -316,14 +453,15 @@ class TimeSeriesAnalyzer:
         
         
         # Apply FFT
-        n = len(data_box_mean)
-        fft_ds = fft(data_box_mean)
-        freq = np.fft.fftfreq(n, d=1)
-        periods = np.where(freq != 0, 1 / freq, np.inf)
-        
-        # Compute power spectrum
-        
-        power_spec = np.abs(fft_ds) ** 2
+        with self._stage('fft', variable) as event:
+            event.track(data_box_mean)
+            n = len(data_box_mean)
+            fft_ds = fft(data_box_mean)
+            freq = np.fft.fftfreq(n, d=1)
+            periods = np.where(freq != 0, 1 / freq, np.inf)
+
+            # Compute power spectrum
+            power_spec = np.abs(fft_ds) ** 2
 
         # Identify significant periods
         threshold = np.mean(power_spec) + 2 * np.std(power_spec)
@@ -339,6 +477,10 @@ class TimeSeriesAnalyzer:
         """
         Performs wavelet analysis using pycwt on the selected variable.
         """
+        import matplotlib.pyplot as plt
+        import pycwt as wavelet
+        from scipy.stats import chi2
+
         # Check if detrended anomalies for the specific variable have been calculated
         if use_detrended and (self._ds_anom_detrended is None or variable not in self._ds_anom_detrended):
             # Compute anomalies and detrend them if they don't exist yet
@@ -380,8 +522,10 @@ class TimeSeriesAnalyzer:
     
 
         # Calculate the wavelet transform using pycwt
-        mother = wavelet.Morlet(6)  # Using the Morlet wavelet
-        wave, scales, freqs, coi, fft, fftfreqs = wavelet.cwt(data_box_mean.values,dt, wavelet=mother)
+        with self._stage('wavelet', variable) as event:
+            event.track(data_box_mean)
+            mother = wavelet.Morlet(6)  # Using the Morlet wavelet
+            wave, scales, freqs, coi, fft, fftfreqs = wavelet.cwt(data_box_mean.values,dt, wavelet=mother)
 
         wave = wave[:, :len(time)] 
         # Manually calculate significance using chi-square distribution
@@ -1,7 +1,6 @@
 
 import numpy as np
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
+import xarray as xr
 
 def calculate_nino34_index(sst_anom_detrended):
     """
@@ -36,10 +35,114 @@ def calculate_composites(anom_detrended, nino34_index):
 
     return anom_positive, anom_negative
 
+def _remove_mean(x):
+    """
+    Subtracts the mean along the last axis, ignoring missing values (all-NaN series stay NaN).
+    """
+    valid = ~np.isnan(x)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x - np.where(valid, x, 0).sum(-1, keepdims=True) / valid.sum(-1, keepdims=True)
+
+
+def _lag1_autocorrelation(x):
+    """
+    Lag-1 autocorrelation along the last axis, ignoring missing values.
+    """
+    x = _remove_mean(x)
+    a, b = x[..., 1:], x[..., :-1]
+    valid = ~np.isnan(a) & ~np.isnan(b)
+    a, b = np.where(valid, a, 0), np.where(valid, b, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (a * b).sum(-1) / np.sqrt((a**2).sum(-1) * (b**2).sum(-1))
+
+
+def _lagged_statistics(field, index, max_lag):
+    """
+    Computes correlation, regression, effective sample size and p-value between field (..., time)
+    and index (..., time, broadcastable against field) for all lags -max_lag..max_lag with FFT cross-correlations.
+
+    All sums over the overlapping, valid time steps of each lag (counts, sums, sums of squares and
+    cross products) are cross-correlations of the two series and their masks, so they are obtained
+    for every lag at once from the Fourier transforms.
+    """
+    from scipy.stats import t as t_dist
+
+    field = _remove_mean(field)
+    index = _remove_mean(index)
+    mask_f, mask_i = ~np.isnan(field), ~np.isnan(index)
+    f, i = np.where(mask_f, field, 0.0), np.where(mask_i, index, 0.0)
+
+    n_time = field.shape[-1]
+    nfft = int(2 ** np.ceil(np.log2(n_time + max_lag)))  # zero padding avoids circular wrap-around
+    lags = np.arange(-max_lag, max_lag + 1)
+
+    F = {name: np.fft.rfft(a, nfft, axis=-1) for name, a in [('f', f), ('ff', f**2), ('m', mask_f.astype(float))]}
+    I = {name: np.conj(np.fft.rfft(a, nfft, axis=-1)) for name, a in [('i', i), ('ii', i**2), ('m', mask_i.astype(float))]}
+
+    def xcorr(a, b):
+        # sum_t a[t + lag] * b[t] for all lags; negative lags are at the end of the irfft output
+        return np.fft.irfft(F[a] * I[b], nfft, axis=-1)[..., lags % nfft]
+
+    n = np.round(xcorr('m', 'm'))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_f, mean_i = xcorr('f', 'm') / n, xcorr('m', 'i') / n
+        cov = xcorr('f', 'i') / n - mean_f * mean_i
+        var_f = xcorr('ff', 'm') / n - mean_f**2
+        var_i = xcorr('m', 'ii') / n - mean_i**2
+        correlation = np.clip(cov / np.sqrt(var_f * var_i), -1, 1)
+        regression = cov / var_i
+
+        # Effective sample size for autocorrelated series (Bretherton et al., 1999)
+        r1 = (_lag1_autocorrelation(field) * _lag1_autocorrelation(index))[..., None]
+        n_eff = np.clip(n * (1 - r1) / (1 + r1), 2, n)
+        t_value = correlation * np.sqrt((n_eff - 2) / (1 - correlation**2))
+        p_value = 2 * t_dist.sf(np.abs(t_value), np.maximum(n_eff - 2, 1))
+
+    invalid = n < 3
+    return tuple(np.where(invalid, np.nan, a) for a in (correlation, regression, n_eff, p_value))
+
+
+def calculate_lagged_regression(anom_detrended, index, max_lag=24):
+    """
+    Calculate lead-lag correlation and regression maps between a field and a climate index
+    (e.g. the Niño3.4 index) for all lags from -max_lag to +max_lag in one pass over the data.
+
+    Positive lags mean that the index leads the field: the map at lag k relates the field at
+    time t + k to the index at time t. The computation uses FFT cross-correlations along time
+    and runs chunk by chunk over space for dask arrays (time is kept in one chunk).
+
+    Parameters:
+    - anom_detrended: xarray.DataArray of anomalies with a time dimension (e.g. time, lat, lon).
+    - index: xarray.DataArray with the index time series (time).
+    - max_lag: Largest lag in time steps (e.g. 24 months).
+
+    Returns:
+    - xarray.Dataset with the dimension 'lag' and the variables
+        correlation: Correlation coefficient.
+        regression: Regression coefficient (field units per unit of the index).
+        n_eff: Effective sample size, accounting for the lag-1 autocorrelation of both series.
+        p_value: Two-sided p-value of the correlation based on n_eff.
+    """
+    anom_detrended, index = xr.align(anom_detrended, index, join='inner')
+    names = ['correlation', 'regression', 'n_eff', 'p_value']
+    results = xr.apply_ufunc(
+        _lagged_statistics, anom_detrended, index,
+        kwargs={'max_lag': max_lag},
+        input_core_dims=[['time'], ['time']],
+        output_core_dims=[['lag']] * len(names),
+        dask='parallelized',
+        output_dtypes=[float] * len(names),
+        dask_gufunc_kwargs={'output_sizes': {'lag': 2 * max_lag + 1}, 'allow_rechunk': True},
+    )
+    ds = xr.Dataset(dict(zip(names, results))).assign_coords(lag=np.arange(-max_lag, max_lag + 1))
+    ds['lag'].attrs['description'] = 'Positive lags: the index leads the field.'
+    return ds
+
 def plot_composites(anom_positive, anom_negative, vmin=-1.5, vmax=1.5,label ='°C',variable = 'SST'):
     """
     Plot composites for positive and negative ENSO events.
     """
+    import matplotlib.pyplot as plt
    
 
     # Create a figure with two subplots (1x2 layout)
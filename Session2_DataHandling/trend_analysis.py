@@ -1,11 +1,15 @@
-from scipy.stats import linregress
 import xarray as xr
 import numpy as np
 
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
-from matplotlib.ticker import MaxNLocator
+# matplotlib, Basemap and scipy.stats are imported inside the functions that need them,
+# so that calculate_trend_per_decade can be used without loading the plotting stack.
 
+try:
+    from profiling import profile_stage
+except ImportError:  # the shared Modules directory is not on the path, profiling is not available
+    def profile_stage(name):
+        """Stand-in for profiling.profile_stage that leaves the function unchanged."""
+        return lambda func: func
 
 
 def calc_trend(y):
@@ -13,6 +17,8 @@ def calc_trend(y):
     Calculates the linear trend (slope) for a time series.
     Multiplies the slope by 10 to convert from Unit/year to Unit/decade.
     """
+    from scipy.stats import linregress
+
     # Assuming y is a numpy array with no missing values, evenly spaced in time (e.g. monthly data)
     x = np.arange(len(y))
     # Apply linear regression
@@ -20,23 +26,33 @@ def calc_trend(y):
     # Multiply by 120 to convert from per year to per decade
     return slope * 120
 
-def calculate_trend_per_decade(data):
+@profile_stage('trend')
+def calculate_trend_per_decade(data, cache=None):
     """
     Apply the calc_trend function to each grid cell to calculate trend per decade.
     
     Parameters:
     - data: xarray.DataArray with variable values.
+    - cache: Optional result_cache.ResultCache (from the Modules directory) to reuse trends
+             computed before for the same data.
     
     Returns:
     - trend_decade: xarray.DataArray with variable trend per decade for each grid cell.
     """
-    trend_decade = xr.apply_ufunc(
-        calc_trend,
-        data,
-        vectorize=True,
-        input_core_dims=[['time']],  # Time is the core dimension
-        dask='allowed'  # Allow Dask for parallel computation
-    )
+    def compute():
+        return xr.apply_ufunc(
+            calc_trend,
+            data,
+            vectorize=True,
+            input_core_dims=[['time']],  # Time is the core dimension
+            dask='parallelized',  # Apply calc_trend chunk by chunk for Dask arrays
+            output_dtypes=[float],
+            dask_gufunc_kwargs={'allow_rechunk': True}  # Time may be split into several chunks
+        )
+
+    if cache is None:
+        return compute()
+    trend_decade = cache.get_or_compute(data, 'trend_analysis.calculate_trend_per_decade', {}, compute)
     return trend_decade
 
 
@@ -50,6 +66,9 @@ def plot_trend(trend_decade, vmin=-0.5, vmax=0.5):
     - vmin: Minimum value for colorbar (default is -0.5).
     - vmax: Maximum value for colorbar (default is 0.5).
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import MaxNLocator
+
     # Create symmetrical contour levels centered around zero
     trend_levels = MaxNLocator(nbins=21).tick_values(vmin, vmax)
 
@@ -100,6 +119,33 @@ def plot_trend_with_basemap(trend_decade, vmin=-0.5, vmax=0.5, variable = 'SST',
     - vmin: Minimum value for colorbar (default is -0.5).
     - vmax: Maximum value for colorbar (default is 0.5).
     """
+    import matplotlib.pyplot as plt
+
+    # Create a figure for the map
+    fig, ax = plt.subplots(figsize=(12, 7))
+    title = f'Trend of {variable} per Grid Cell per Decade ({label}/decade)'
+
+    try:
+        from map_rendering import draw_map
+    except ImportError:
+        # The shared Modules directory is not on the path, draw the map with Basemap directly
+        _draw_trend_basemap(ax, trend_decade, vmin, vmax, central_lon, f'{label}/decade', title)
+    else:
+        # Draw the trend on the Robinson projection. The Basemap object, the projected grid and the
+        # coastlines are cached by map_rendering, so repeated calls do not rebuild them.
+        draw_map(ax, trend_decade, vmin=vmin, vmax=vmax, label=f'{label}/decade', title=title,
+                 central_lon=central_lon)
+
+    #plt.savefig("trend.png", transparent=True)
+    # Show the plot
+    plt.show()
+
+
+def _draw_trend_basemap(ax, trend_decade, vmin, vmax, central_lon, label, title):
+    """Draws the trend map with an uncached Basemap (used if map_rendering is not available)."""
+    from mpl_toolkits.basemap import Basemap
+    from matplotlib.ticker import MaxNLocator
+
     # Adjust longitude for 180° as central
     trend_decade = adjust_longitude(trend_decade, central_lon)
 
@@ -109,11 +155,8 @@ def plot_trend_with_basemap(trend_decade, vmin=-0.5, vmax=0.5, variable = 'SST',
     # Generate the meshgrid for contouring
     lons, lats = np.meshgrid(trend_decade.lon, trend_decade.lat)
 
-    # Create a figure with Basemap (Robinson projection, centered at 180°)
-    fig, ax = plt.subplots(figsize=(12, 7))
-
     # Define the map projection using Robinson with 180° central longitude
-    m = Basemap(projection='robin', lon_0=central_lon, ax=ax)  # Central longitude set to 180°
+    m = Basemap(projection='robin', lon_0=central_lon, ax=ax)
 
     # Transform coordinates into the projection
     x, y = m(lons, lats)
@@ -121,10 +164,8 @@ def plot_trend_with_basemap(trend_decade, vmin=-0.5, vmax=0.5, variable = 'SST',
     # Plot the trend data using contourf
     cf = m.contourf(x, y, trend_decade, levels=trend_levels, cmap='RdBu_r', extend='neither')
 
-    # Add coastlines for context
+    # Add coastlines and continents for context
     m.drawcoastlines()
-
-    # Fill continents for better visibility
     m.fillcontinents(color='white', lake_color='lightblue')
 
     # Add gridlines for orientation
@@ -133,15 +174,10 @@ def plot_trend_with_basemap(trend_decade, vmin=-0.5, vmax=0.5, variable = 'SST',
 
     # Add contour lines to make the levels stand out
     contour_lines = m.contour(x, y, trend_decade, levels=trend_levels, colors='grey', linewidths=0.5)
-    plt.clabel(contour_lines, inline=True, fontsize=8, fmt='%1.2f')
+    ax.clabel(contour_lines, inline=True, fontsize=8, fmt='%1.2f')
 
     # Plot the colorbar
     cbar = m.colorbar(cf, location='right', pad='5%', aspect=40)
-    cbar.set_label(f'{label}/decade')
+    cbar.set_label(label)
     cbar.ax.yaxis.set_major_locator(MaxNLocator(nbins=7))
-
-    # Add a title to the plot
-    plt.title(f'Trend of {variable} per Grid Cell per Decade ({label}/decade)')
-    #plt.savefig("trend.png", transparent=True)
-    # Show the plot
-    plt.show()
\ No newline at end of file
+    ax.set_title(title)